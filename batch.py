@@ -0,0 +1,360 @@
+import state
+import canonical
+import dense
+import search
+import solver
+import argparse
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+
+# Each worker builds one solver up front, and one Sudoku for each board size it
+# is given, and reuses them for every puzzle, rolling the puzzle back to its
+# empty state in between.
+_worker = None
+
+def _init_worker(bifurcation_level, compact, complete, adaptive, cache_size, cache_file, trace, messages, timeout,
+    max_steps, send_cache=False):
+  global _worker
+  cache = canonical.SolutionCache(cache_size, cache_file) if cache_size else None
+  if cache is not None and send_cache:
+    # results carry the entries added, for the main process to save
+    cache.added = []
+  _worker = Worker(bifurcation_level=bifurcation_level, compact=compact, complete=complete, adaptive=adaptive,
+    cache=cache, trace=trace, messages=messages, timeout=timeout, max_steps=max_steps)
+
+class Worker:
+  def __init__(self, bifurcation_level=0, compact=True, complete=False, adaptive=False, cache=None, trace=False,
+      messages=False, timeout=None, max_steps=None):
+    self.compact = compact
+    # board size -> Sudoku
+    self.puzzles = {}
+    # with 'adaptive', each worker learns its own deducer order as it goes
+    schedule = solver.Schedule() if adaptive else None
+    self.solver = solver.SudokuSolver(bifurcation_level=bifurcation_level, schedule=schedule)
+    # finish puzzles the deducers can't with a backtracking search
+    self.search_solver = search.get_search_solver() if complete else None
+    # a canonical.SolutionCache, to look up grids the same as one solved
+    # before up to symmetry instead of solving them again
+    self.cache = cache
+    # whether to return each step as a solver.trace_record, and whether
+    # records hold deduction messages
+    self.trace = trace
+    self.messages = messages
+    # the budget of each solve, see solver.Solver.solve
+    self.timeout = timeout
+    self.max_steps = max_steps
+  def solve(self, grid, options=None):
+    """
+    Solves a grid of any board size (81 characters for 9x9, 256 for 16x16
+    and so on, see state.Sudoku.from_string), returning a dict with the
+    'solution' (with '.' for any cell left unsolved), whether it was 'solved',
+    the number of deduction 'steps' and the solve 'time' in seconds. With a
+    cache, whether the result was 'cached' is added. With 'trace', the
+    'trace' of steps is added as a list of solver.trace_record records,
+    without messages for cached results. With 'options', cell -> options
+    known to hold for the grid (as a dense.Batch gives), the solver starts
+    from those instead of the givens. A solve cut short by the worker's
+    'timeout' (in seconds, from when the grid is given) or 'max_steps' adds
+    why as 'stopped' ('deadline' or 'steps'), and isn't finished by search or
+    cached.
+    """
+    puzzle = self.puzzle(grid)
+    puzzle.checkpoint()
+    try:
+      start = time.perf_counter()
+      puzzle.load_from_string(grid)
+      form = cached = stopped = None
+      records = [] if self.trace else None
+      if self.cache is not None:
+        form = canonical.canonical_form(puzzle)
+        cached = self.cache.get(form)
+      if cached is not None:
+        cell_options, trace = cached
+        for cid, opts in cell_options.items():
+          puzzle.cell_options[cid] = opts
+        steps = len(trace)
+        if records is not None:
+          layout = solver.trace_layout(puzzle)
+          records = [(name, kind, [(layout.index[cid], layout.encode(opts)) for cid, opts in step], None)
+            for name, kind, step in trace]
+      else:
+        for cid, opts in (options or {}).items():
+          puzzle.cell_options[cid] = opts
+        trace = []
+        def step(deducer_name, found):
+          if form is not None:
+            trace.append((deducer_name, found.kind, [(cid, puzzle.cell_options[cid]) for cid in found.cells_affected]))
+          if records is not None:
+            records.append(solver.trace_record(puzzle, deducer_name, found, self.messages))
+        timeout = None if self.timeout is None else self.timeout-(time.perf_counter()-start)
+        outcome = self.solver.solve(puzzle, timeout=timeout, max_steps=self.max_steps, step=step)
+        steps = len(outcome.deductions)
+        if outcome.stopped:
+          stopped = outcome.reason
+        elif self.search_solver is not None and puzzle.free_cells() > 0 and not puzzle.broken():
+          solution = search.solve(puzzle, self.search_solver)
+          if solution is not None:
+            for cid, opts in solution.items():
+              puzzle.cell_options[cid] = opts
+        if form is not None and stopped is None:
+          self.cache.put(form, puzzle.cell_options, trace)
+      solved = puzzle.free_cells() == 0 and not puzzle.broken() and puzzle.constraints_satisfied()
+      result = {
+        'solution': puzzle.to_string(),
+        'solved': solved,
+        'steps': steps,
+        'time': time.perf_counter()-start,
+      }
+      if self.cache is not None:
+        result['cached'] = cached is not None
+        if self.cache.added:
+          result['cache_entries'] = self.cache.added
+          self.cache.added = []
+      if stopped is not None:
+        result['stopped'] = stopped
+      if records is not None:
+        result['trace'] = records
+      return result
+    finally:
+      puzzle.rollback()
+  def solve_batch(self, grids):
+    """
+    Returns a result like 'solve' gives for each grid, making the cheap
+    deductions on all the grids of a board size at once with a dense.Batch,
+    so only those it leaves unsolved are put through the solver. 'steps' only
+    counts the solver's steps, and 'time' includes an even share of the
+    batch's. A grid that can't be read gets an 'error' result.
+    """
+    results = [None]*len(grids)
+    # board size -> [(index, cells)]
+    sizes = {}
+    for i, grid in enumerate(grids):
+      try:
+        size, cells = dense.parse(grid)
+      except ValueError as e:
+        results[i] = _error(e)
+        continue
+      sizes.setdefault(size, []).append((i, cells))
+    for size, items in sizes.items():
+      start = time.perf_counter()
+      box_rows, box_cols = state.Sudoku.box_shape(size)
+      batch = dense.Batch([cells for _, cells in items], box_rows, box_cols)
+      batch.eliminate()
+      solved = batch.solved()
+      share = (time.perf_counter()-start)/len(items)
+      for n, (i, _) in enumerate(items):
+        if not solved[n]:
+          result = self.solve(grids[i], options=batch.cell_options(n))
+          result['time'] += share
+          results[i] = result
+          continue
+        result = {'solution': batch.to_string(n), 'solved': True, 'steps': 0, 'time': share}
+        if self.cache is not None:
+          result['cached'] = False
+        if self.trace:
+          result['trace'] = []
+        results[i] = result
+    return results
+  def puzzle(self, grid):
+    # The empty Sudoku for the grid's board size.
+    cells = len(grid.strip())
+    size = int(round(cells**0.5))
+    if size*size != cells or size > len(state.Sudoku.SYMBOLS):
+      raise ValueError('{} cells is not a square board'.format(cells))
+    puzzle = self.puzzles.get(size)
+    if puzzle is None:
+      box_rows, box_cols = state.Sudoku.box_shape(size)
+      puzzle = self.puzzles[size] = state.Sudoku(compact=self.compact, box_rows=box_rows, box_cols=box_cols)
+    return puzzle
+
+def _parse(line, fmt):
+  # Returns (record, grid) for an input line, where 'record' holds any fields
+  # to pass through to the output.
+  if fmt == 'jsonl':
+    record = json.loads(line)
+    return record, record['puzzle']
+  return None, line.strip()
+
+def _solve_line(item):
+  line, fmt = item
+  try:
+    record, grid = _parse(line, fmt)
+  except (ValueError, KeyError, TypeError) as e:
+    return None, _error(e)
+  # a record read but not solved keeps its fields, so the error can be told
+  # apart by them
+  try:
+    result = _worker.solve(grid)
+  except (ValueError, KeyError, TypeError) as e:
+    result = _error(e)
+  return record, result
+
+def _solve_chunk(chunk):
+  # _solve_line for a list of items at once, with Worker.solve_batch.
+  records = []
+  grids = []
+  for line, fmt in chunk:
+    try:
+      record, grid = _parse(line, fmt)
+    except (ValueError, KeyError, TypeError) as e:
+      records.append((None, _error(e)))
+      continue
+    records.append((record, None))
+    grids.append(grid)
+  results = iter(_worker.solve_batch(grids))
+  out = []
+  for record, result in records:
+    if result is None:
+      result = next(results)
+    out.append((record, result))
+  return out
+
+def _chunks(items, size):
+  items = iter(items)
+  while True:
+    chunk = list(itertools.islice(items, size))
+    if not chunk:
+      return
+    yield chunk
+
+def _error(e):
+  return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+def _format(record, result, fmt):
+  if fmt == 'jsonl':
+    out = dict(record) if record else {}
+    out.update(result)
+    return json.dumps(out)
+  return result.get('solution', '')
+
+def detect_format(line):
+  return 'jsonl' if line.lstrip().startswith('{') else 'line'
+
+def solve_stream(lines, fmt='auto', workers=None, chunksize=64, bifurcation_level=0, compact=True, complete=False,
+    adaptive=False, cache_size=0, cache_file=None, trace=None, vectorize=False, timeout=None, max_steps=None):
+  """
+  Solves puzzles read from 'lines' and yields one output line per input line,
+  in input order. Blank input lines are skipped.
+  'fmt' is 'line' (a grid per puzzle, '0' or '.' for blanks), 'jsonl'
+  (objects with a 'puzzle' field, other fields are passed through) or 'auto'
+  to decide from the first puzzle.
+  Line output is the solved grid, with '.' for unsolved cells, or an empty
+  line if the puzzle could not be read. JSONL output adds 'solution', 'solved',
+  'steps' and 'time' fields, or an 'error' field.
+  With 'workers' other than 1, puzzles are sent to a process pool of that many
+  workers (all cores if None), 'chunksize' puzzles at a time.
+  With 'complete', puzzles the deducers can't finish are solved by search.
+  With 'adaptive', deducers are ordered by a solver.Schedule instead of the
+  fixed order, so the deductions made may differ from run to run.
+  With a 'cache_size', each worker keeps the results of up to that many grids
+  in a canonical.SolutionCache, so grids that are the same up to symmetry are
+  only solved once per worker. A 'cache_file' is loaded by every worker, and
+  at the end saved with the entries the workers added.
+  With a solver.TraceWriter as 'trace', the steps taken on each puzzle are
+  written to it, as one puzzle per input line.
+  With 'vectorize', 'chunksize' puzzles at a time go through a dense.Batch
+  (which needs NumPy) and only those it can't solve through the solver. Their
+  steps and traces only cover the solver's part.
+  With a 'timeout' (seconds per puzzle) or 'max_steps', solves that run out
+  give the cells solved so far, and JSONL output has a 'stopped' field.
+  """
+  lines = (line for line in lines if line.strip())
+  if fmt == 'auto':
+    try:
+      first = next(lines)
+    except StopIteration:
+      return
+    fmt = detect_format(first)
+    lines = itertools.chain([first], lines)
+  items = ((line, fmt) for line in lines)
+  initargs = (bifurcation_level, compact, complete, adaptive, cache_size, cache_file, trace is not None,
+    trace is not None and trace.messages, timeout, max_steps)
+  if vectorize:
+    if dense.numpy is None:
+      raise ImportError('vectorize needs NumPy')
+    # each chunk is one item to the pool
+    solve, items, chunksize = _solve_chunk, _chunks(items, chunksize), 1
+  else:
+    solve = _solve_line
+  if workers == 1:
+    _init_worker(*initargs)
+    for record, result in _flatten(map(solve, items), vectorize):
+      yield _format(record, _write_trace(result, trace), fmt)
+    if _worker.cache is not None and cache_file is not None:
+      _worker.cache.save()
+    return
+  # the workers' caches can't be saved from their processes, so what they add
+  # is sent back and saved from this one
+  saved = canonical.SolutionCache(cache_size, cache_file) if cache_size and cache_file is not None else None
+  initargs += (saved is not None,)
+  with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+    for record, result in _flatten(pool.imap(solve, items, chunksize), vectorize):
+      entries = result.pop('cache_entries', None)
+      if entries:
+        saved.merge(entries)
+      yield _format(record, _write_trace(result, trace), fmt)
+  if saved is not None:
+    saved.save()
+
+def _flatten(results, chunked):
+  return itertools.chain.from_iterable(results) if chunked else results
+
+def _write_trace(result, trace):
+  # Writes a result's trace records to 'trace', if any, and returns the
+  # result without them.
+  records = result.pop('trace', None)
+  if trace is not None:
+    trace.start()
+    for record in records or ():
+      trace.write(record)
+  return result
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Solve a stream of sudoku puzzles.')
+  parser.add_argument('input', nargs='?', default='-', help='puzzle file, or - for stdin')
+  parser.add_argument('-o', '--output', default='-', help='output file, or - for stdout')
+  parser.add_argument('-f', '--format', default='auto', choices=['auto', 'line', 'jsonl'])
+  parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+  parser.add_argument('-c', '--chunksize', type=int, default=64, help='puzzles sent to a worker at a time')
+  parser.add_argument('-b', '--bifurcation', type=int, default=0, help='bifurcation level for hard puzzles')
+  parser.add_argument('--complete', action='store_true', help='finish puzzles the deducers cannot with search')
+  parser.add_argument('--adaptive', action='store_true', help='learn a faster deducer order as puzzles are solved')
+  parser.add_argument('--list-mode', action='store_true', help='store cell options as lists instead of bitsets')
+  parser.add_argument('--cache', type=int, default=0, help='grids per worker to cache results of by canonical form')
+  parser.add_argument('--cache-file', help='file to load the --cache from and save it to')
+  parser.add_argument('--timeout', type=float, help='seconds to spend on each puzzle before giving up')
+  parser.add_argument('--max-steps', type=int, help='deductions to make on each puzzle before giving up')
+  parser.add_argument('--vectorize', action='store_true',
+    help='make singles and pointing deductions on each chunk at once with NumPy')
+  parser.add_argument('--trace', help='file to write the steps taken on each puzzle to')
+  parser.add_argument('--trace-format', default='jsonl', choices=['jsonl', 'binary'])
+  parser.add_argument('--trace-messages', action='store_true', help='add deduction messages to a JSONL --trace')
+  args = parser.parse_args(argv)
+  if args.vectorize and dense.numpy is None:
+    parser.error('--vectorize needs NumPy')
+  infile = sys.stdin if args.input == '-' else open(args.input)
+  outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+  tracefile = trace = None
+  if args.trace:
+    tracefile = open(args.trace, 'wb' if args.trace_format == 'binary' else 'w')
+    trace = solver.TraceWriter(tracefile, args.trace_format, messages=args.trace_messages)
+  try:
+    for line in solve_stream(infile, fmt=args.format, workers=args.workers, chunksize=args.chunksize,
+        bifurcation_level=args.bifurcation, compact=not args.list_mode, complete=args.complete,
+        adaptive=args.adaptive, cache_size=args.cache, cache_file=args.cache_file, trace=trace,
+        vectorize=args.vectorize, timeout=args.timeout, max_steps=args.max_steps):
+      outfile.write(line)
+      outfile.write('\n')
+  finally:
+    if infile is not sys.stdin:
+      infile.close()
+    if outfile is not sys.stdout:
+      outfile.close()
+    if tracefile is not None:
+      tracefile.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,159 @@
+import state
+import solver
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+# Tiers in order of difficulty, named after the hardest SudokuSolver deducer
+# their puzzles need.
+TIERS = solver.TIERS
+# Tiers of other board sizes, to show how solving scales with the board.
+SIZE_TIERS = ['size6', 'size16', 'size25']
+
+def load_corpus(tiers=None, corpus_dir=CORPUS_DIR):
+  # Returns {tier: [grid]}, read from '<corpus_dir>/<tier>.txt'.
+  corpus = {}
+  for tier in (tiers or TIERS):
+    with open(os.path.join(corpus_dir, '{}.txt'.format(tier))) as f:
+      corpus[tier] = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+  return corpus
+
+def percentile(values, p):
+  # Nearest-rank percentile of an already sorted list.
+  if not values:
+    return None
+  rank = max(1, int(-(-p*len(values)//100)))
+  return values[rank-1]
+
+def solve(sudoku_solver, puzzle):
+  # Runs the solver to completion, returning the number of steps taken and
+  # the most derived constraints the puzzle had at once.
+  steps = derived = 0
+  deduction = True
+  while deduction and puzzle.free_cells() > 0 and not puzzle.broken():
+    deduction = sudoku_solver.make_deduction(puzzle)
+    if deduction:
+      steps += 1
+      derived = max(derived, len(puzzle.derived_constraints))
+  return steps, derived
+
+def run_tier(grids, bifurcation_level=1, compact=True, adaptive=False):
+  latencies = []
+  steps = []
+  derived = []
+  solved = 0
+  schedule = solver.Schedule() if adaptive else None
+  sudoku_solver = solver.SudokuSolver(bifurcation_level=bifurcation_level, schedule=schedule)
+  profile = sudoku_solver.profile = solver.Profile()
+  for grid in grids:
+    puzzle = state.Sudoku.from_string(grid, compact=compact)
+    start = time.perf_counter()
+    puzzle_steps, puzzle_derived = solve(sudoku_solver, puzzle)
+    latencies.append(time.perf_counter()-start)
+    steps.append(puzzle_steps)
+    derived.append(puzzle_derived)
+    if puzzle.free_cells() == 0 and puzzle.constraints_satisfied():
+      solved += 1
+  total = sum(latencies)
+  latencies.sort()
+  return {
+    'puzzles': len(grids),
+    'solved': solved,
+    'time': total,
+    'puzzles_per_sec': len(grids)/total if total else None,
+    'latency': {
+      'mean': total/len(grids) if grids else None,
+      'p50': percentile(latencies, 50),
+      'p99': percentile(latencies, 99),
+      'max': latencies[-1] if latencies else None,
+    },
+    'steps': {
+      'total': sum(steps),
+      'mean': sum(steps)/len(steps) if steps else None,
+      'max': max(steps) if steps else None,
+    },
+    # the most derived (tuple) constraints a puzzle had at once
+    'derived_constraints': {
+      'mean': sum(derived)/len(derived) if derived else None,
+      'max': max(derived) if derived else None,
+    },
+    # top level deducers by label, and nested ones by their ' > ' joined path
+    'deducers': {' > '.join(path): stats.to_dict() for path, stats in profile.stats.items()},
+  }
+
+def run(corpus, bifurcation_level=1, compact=True, limit=None, adaptive=False):
+  results = {
+    'meta': {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'bifurcation_level': bifurcation_level,
+      'compact': compact,
+      'adaptive': adaptive,
+    },
+    'tiers': {},
+  }
+  for tier, grids in corpus.items():
+    results['tiers'][tier] = run_tier(grids[:limit], bifurcation_level=bifurcation_level, compact=compact, adaptive=adaptive)
+  return results
+
+def _ms(seconds):
+  return '-' if seconds is None else '{:.1f}'.format(1000*seconds)
+
+def report(results, out=sys.stdout):
+  out.write('{:<12} {:>7} {:>7} {:>10} {:>9} {:>9} {:>7} {:>8}\n'.format(
+    'tier', 'puzzles', 'solved', 'puzzles/s', 'p50 ms', 'p99 ms', 'steps', 'derived'))
+  for tier, r in results['tiers'].items():
+    out.write('{:<12} {:>7} {:>7} {:>10.2f} {:>9} {:>9} {:>7.1f} {:>8}\n'.format(
+      tier, r['puzzles'], r['solved'], r['puzzles_per_sec'] or 0,
+      _ms(r['latency']['p50']), _ms(r['latency']['p99']), r['steps']['mean'] or 0,
+      r['derived_constraints']['max'] or 0))
+  for tier, r in results['tiers'].items():
+    out.write('\n{} deducers (inclusive time):\n'.format(tier))
+    for label, stats in r['deducers'].items():
+      if ' > ' not in label:
+        out.write('  {:<28} {:>8} calls {:>6} hits {:>10} ms {:>8} max ms\n'.format(
+          label, stats['calls'], stats['hits'], _ms(stats['time']), _ms(stats['max_time'])))
+
+def compare(old, new, out=sys.stdout):
+  # Prints the change in throughput and median latency for tiers in both runs.
+  out.write('{:<12} {:>12} {:>12} {:>8}\n'.format('tier', 'old p50 ms', 'new p50 ms', 'speedup'))
+  for tier, r in new['tiers'].items():
+    if tier not in old['tiers']:
+      continue
+    o = old['tiers'][tier]
+    speedup = o['time']/r['time'] if r['time'] and o['puzzles'] == r['puzzles'] else None
+    out.write('{:<12} {:>12} {:>12} {:>8}\n'.format(tier, _ms(o['latency']['p50']), _ms(r['latency']['p50']),
+      '-' if speedup is None else '{:.2f}x'.format(speedup)))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark SudokuSolver on the graded puzzle corpus.')
+  parser.add_argument('-t', '--tiers', default=','.join(TIERS),
+    help='comma separated tiers to run, from {}'.format(', '.join(TIERS+SIZE_TIERS)))
+  parser.add_argument('-n', '--limit', type=int, default=None, help='puzzles per tier')
+  parser.add_argument('-b', '--bifurcation', type=int, default=1, help='bifurcation level')
+  parser.add_argument('--list-mode', action='store_true', help='store cell options as lists instead of bitsets')
+  parser.add_argument('--adaptive', action='store_true', help='order deducers by a learnt solver.Schedule')
+  parser.add_argument('--corpus', default=CORPUS_DIR, help='corpus directory')
+  parser.add_argument('-o', '--output', help='write results as JSON to this file')
+  parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+  args = parser.parse_args(argv)
+  corpus = load_corpus(args.tiers.split(','), args.corpus)
+  results = run(corpus, bifurcation_level=args.bifurcation, compact=not args.list_mode, limit=args.limit,
+    adaptive=args.adaptive)
+  report(results)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      old = json.load(f)
+    sys.stdout.write('\n')
+    compare(old, results)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,273 @@
+import state
+import collections
+import itertools
+import os
+import pickle
+import tempfile
+
+class Transform:
+  """
+  A symmetry of a sudoku board, taking a grid to its canonical form: an
+  optional transposition, then a reordering of rows and columns that keeps
+  bands and stacks together, then a relabelling of options. Canonical row i
+  is row 'rows[i]' of the (possibly transposed) grid, and likewise for
+  'cols', both 0 based, and 'options' maps each option to its label.
+  """
+  def __init__(self, transpose, rows, cols, options):
+    self.transpose = transpose
+    self.rows = tuple(rows)
+    self.cols = tuple(cols)
+    self.options = dict(options)
+    self._row_of = {r: i for i, r in enumerate(self.rows)}
+    self._col_of = {c: i for i, c in enumerate(self.cols)}
+    self._option_of = {label: opt for opt, label in self.options.items()}
+  def cell(self, cid):
+    # The canonical cell of cell 'cid' (1 based, like Sudoku's).
+    r, c = cid
+    if self.transpose:
+      r, c = c, r
+    return (self._row_of[r-1]+1, self._col_of[c-1]+1)
+  def inverse_cell(self, cid):
+    r, c = self.rows[cid[0]-1]+1, self.cols[cid[1]-1]+1
+    return (c, r) if self.transpose else (r, c)
+  def option(self, opt):
+    return self.options[opt]
+  def inverse_option(self, label):
+    return self._option_of[label]
+
+def _grid(puzzle):
+  # The puzzle's solved cells as rows of options, 0 where unsolved.
+  return [[(lambda opts: opts[0] if len(opts) == 1 else 0)(puzzle.cell_options[(r, c)])
+    for c in range(1, puzzle.size+1)] for r in range(1, puzzle.size+1)]
+
+def _distinct(lines):
+  for line in lines:
+    given = [v for v in line if v]
+    if len(given) != len(set(given)):
+      return False
+  return True
+
+def canonical_form(puzzle, max_states=4096):
+  """
+  Returns (key, transform) for the solved cells of a state.Sudoku, where
+  'key' is the same for every grid that one of the board's symmetries (and
+  relabelling options) takes to another, and 'transform' takes this grid to
+  the one 'key' describes. The canonical grid is the least, read row by row
+  with blanks first and options labelled in order of first appearance.
+
+  The search keeps every partial transform that ties for the least grid so
+  far, so grids with many symmetries take longer. None is returned if more
+  than 'max_states' tie, or if a row or column repeats an option.
+  """
+  size, box_rows, box_cols = puzzle.size, puzzle.box_rows, puzzle.box_cols
+  grid = _grid(puzzle)
+  columns = [list(col) for col in zip(*grid)]
+  if not _distinct(grid) or not _distinct(columns):
+    return None
+  grids = [grid]
+  # transposing only keeps the board's shape with square boxes
+  if box_rows == box_cols:
+    grids.append(columns)
+  stacks = tuple(tuple(range(s*box_cols, (s+1)*box_cols)) for s in range(size//box_cols))
+  # a state is (grid index, rows so far, column order, labels): the column
+  # order is a tuple of blocks of stacks, each a tuple of blocks of columns,
+  # where stacks in a block (and columns in a block) can go in any order
+  # without changing the rows so far
+  states = [(t, (), (tuple((stack,) for stack in stacks),), {}) for t in range(len(grids))]
+  for i in range(size):
+    best, best_key = [], None
+    for state_ in states:
+      t, rows, order, labels = state_
+      for x in _next_rows(rows, size, box_rows):
+        key = _row_key(grids[t][x], order, labels)
+        if best_key is None or key < best_key:
+          best, best_key = [(state_, x)], key
+        elif key == best_key:
+          best.append((state_, x))
+    states = []
+    for state_, x in best:
+      states.extend(_extend(grids, state_, x))
+      if len(states) > max_states:
+        return None
+  t, rows, order, labels = states[0]
+  cols = [c for block in order for stack in block for col_block in stack for c in col_block]
+  labels = dict(labels)
+  # options not given are labelled after the rest, in order
+  for opt in range(1, size+1):
+    if opt not in labels:
+      labels[opt] = len(labels)+1
+  transform = Transform(t == 1, rows, cols, labels)
+  symbols = state.Sudoku.SYMBOLS
+  key = '{}x{}:'.format(box_rows, box_cols) + ''.join(
+    symbols[labels[v]-1] if v else '.' for x in rows for v in (grids[t][x][c] for c in cols))
+  return key, transform
+
+def _next_rows(rows, size, box_rows):
+  # Rows that can come next: the rest of the current band, or any row of a
+  # band not yet started.
+  if len(rows) % box_rows:
+    band = rows[-1]//box_rows
+    return [r for r in range(band*box_rows, (band+1)*box_rows) if r not in rows]
+  used = set(r//box_rows for r in rows)
+  return [r for r in range(size) if r//box_rows not in used]
+
+# Cells of a row are compared as (0,) if blank, (1, label) if the option has a
+# label, and (2,) if not: unlabelled options are all new to the row, so they
+# are labelled in order whichever is first.
+_NEW = (2,)
+
+def _symbol(v, labels):
+  if not v:
+    return (0,)
+  label = labels.get(v)
+  return _NEW if label is None else (1, label)
+
+def _stack_key(line, stack, labels):
+  key = []
+  for col_block in stack:
+    key.extend(sorted(_symbol(line[c], labels) for c in col_block))
+  return key
+
+def _row_key(line, order, labels):
+  # The least the row can read under the column order.
+  key = []
+  for block in order:
+    for stack_key in sorted(_stack_key(line, stack, labels) for stack in block):
+      key.extend(stack_key)
+  return tuple(key)
+
+def _split(items, key):
+  # Groups sorted 'items' by 'key', as (key, [item]) in order.
+  return [(k, list(group)) for k, group in itertools.groupby(sorted(items, key=key), key=key)]
+
+def _extend(grids, state_, x):
+  # The states row 'x' can be added to 'state_' with, one for each order of
+  # the columns that label its new options differently.
+  t, rows, order, labels = state_
+  line = grids[t][x]
+  symbol = lambda c: _symbol(line[c], labels)
+  # for each block of stacks, the choices of how to order it, each a tuple of
+  # blocks of stacks
+  block_choices = []
+  for block in order:
+    # for each stack, its choices of column blocks
+    stack_choices = {}
+    for stack in block:
+      choices = []
+      for col_block in stack:
+        parts = []
+        for k, cols in _split(col_block, symbol):
+          if k == _NEW:
+            parts.append([tuple((c,) for c in perm) for perm in itertools.permutations(cols)])
+          else:
+            parts.append([(tuple(cols),)])
+        choices.append([sum(part, ()) for part in itertools.product(*parts)])
+      stack_choices[stack] = [sum(choice, ()) for choice in itertools.product(*choices)]
+    parts = []
+    for k, group in _split(block, lambda stack: _stack_key(line, stack, labels)):
+      if _NEW in k and len(group) > 1:
+        # stacks reading the same but with new options in different places
+        parts.append([tuple((stack,) for stack in perm) for perm in itertools.permutations(group)])
+      else:
+        parts.append([(tuple(group),)])
+    choices = []
+    for part in itertools.product(*parts):
+      stack_blocks = sum(part, ())
+      for refined in itertools.product(*(itertools.product(*(stack_choices[s] for s in stack_block)) for stack_block in stack_blocks)):
+        choices.append(tuple(refined))
+    block_choices.append(choices)
+  for choice in itertools.product(*block_choices):
+    new_order = tuple(block for stack_blocks in choice for block in stack_blocks)
+    new_labels = dict(labels)
+    for stack_block in new_order:
+      for stack in stack_block:
+        for col_block in stack:
+          for c in col_block:
+            v = line[c]
+            if v and v not in new_labels:
+              new_labels[v] = len(new_labels)+1
+    yield t, rows+(x,), new_order, new_labels
+
+class SolutionCache:
+  """
+  What solving sudoku grids gave, kept under their canonical forms, so a grid
+  that one seen before maps to by the board's symmetries is a lookup. Each
+  entry holds the options of every cell after solving, and a trace of
+  deduction steps, each (deducer name, deduction kind, [(cell, options
+  after)]), both mapped to and from the canonical grid's cells and options.
+
+  Up to 'max_entries' are kept, dropping the least recently used. With a
+  'path', entries saved there before are loaded, and 'save' writes them back.
+  """
+  def __init__(self, max_entries=4096, path=None):
+    self.max_entries = max_entries
+    self.path = path
+    # canonical key -> (options of each canonical cell in order, trace)
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    # with a list here, 'put' also appends each new (key, entry) to it, so a
+    # process pool's workers can send what they add to the process saving
+    self.added = None
+    if path is not None and os.path.exists(path):
+      with open(path, 'rb') as f:
+        self._entries.update(pickle.load(f))
+      self._evict()
+  def __len__(self):
+    return len(self._entries)
+  def get(self, form):
+    """
+    Returns (cell options, trace) for the grid with 'canonical_form' 'form',
+    as given to 'put' for it or a grid that maps to the same, or None.
+    """
+    entry = self._entries.get(form[0]) if form is not None else None
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._entries.move_to_end(form[0])
+    transform = form[1]
+    cells, trace = entry
+    size = len(transform.rows)
+    cell_options = {}
+    for i, opts in enumerate(cells):
+      cid = transform.inverse_cell((i//size+1, i%size+1))
+      cell_options[cid] = sorted(transform.inverse_option(label) for label in opts)
+    trace = [(name, kind, [(transform.inverse_cell(cid), sorted(transform.inverse_option(label) for label in opts)) for cid, opts in step])
+      for name, kind, step in trace]
+    return cell_options, trace
+  def put(self, form, cell_options, trace=()):
+    # Keeps 'cell_options' (cell -> options after solving) and 'trace' for the
+    # grid with 'canonical_form' 'form', taken before solving.
+    if form is None:
+      return
+    key, transform = form
+    size = len(transform.rows)
+    cells = [None]*(size*size)
+    for cid, opts in cell_options.items():
+      r, c = transform.cell(cid)
+      cells[(r-1)*size+c-1] = tuple(sorted(transform.option(opt) for opt in opts))
+    trace = tuple((name, kind, tuple((transform.cell(cid), tuple(sorted(transform.option(opt) for opt in opts))) for cid, opts in step))
+      for name, kind, step in trace)
+    entry = self._entries[key] = (tuple(cells), trace)
+    self._entries.move_to_end(key)
+    self._evict()
+    if self.added is not None:
+      self.added.append((key, entry))
+  def merge(self, entries):
+    # Adds (key, entry) pairs as 'added' collects them in another cache.
+    for key, entry in entries:
+      self._entries[key] = entry
+      self._entries.move_to_end(key)
+    self._evict()
+  def _evict(self):
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+  def save(self, path=None):
+    # Writes the entries to 'path' (or the cache's), replacing any file there
+    # in one step.
+    path = path or self.path
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+      pickle.dump(list(self._entries.items()), f)
+    os.replace(f.name, path)
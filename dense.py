@@ -0,0 +1,121 @@
+import state
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Vectorised eliminations over many sudoku grids of one board size at once,
+# for bulk solving where most grids only need singles and the per-puzzle cost
+# of the solver's Python loop dominates. Needs NumPy.
+
+def parse(grid):
+  # (size, [option or 0 for each cell, row major]) for a grid as
+  # state.Sudoku.load_from_string takes it.
+  data = grid.strip()
+  size = int(round(len(data)**0.5))
+  if size*size != len(data) or size > len(state.Sudoku.SYMBOLS):
+    raise ValueError('{} cells is not a square board'.format(len(data)))
+  values = {ch: i+1 for i, ch in enumerate(state.Sudoku.SYMBOLS[:size])}
+  cells = []
+  for ch in data:
+    if ch in '0.':
+      cells.append(0)
+    elif ch.upper() in values:
+      cells.append(values[ch.upper()])
+    else:
+      raise ValueError('invalid cell {!r}'.format(ch))
+  return size, cells
+
+class Batch:
+  """
+  Grids of one board size held as a dense (puzzles, cells, options) boolean
+  array 'options', where options[n, i, o] is whether cell i (row major) of
+  puzzle n can still be option o+1.
+
+  'eliminate' makes the deductions of the solver's cheap deducers on every
+  puzzle at once: naked singles (the Constraint Violation deducer), hidden
+  singles (Only Option), and pointing and claiming, where an option confined
+  to one line of a box, or one box of a line, is ruled out from the rest of
+  the line or box (the smallest Pointy-Fish).
+  """
+  def __init__(self, grids, box_rows, box_cols):
+    # 'grids' are lists of options (0 for blank) as 'parse' gives
+    if numpy is None:
+      raise ImportError('dense.Batch needs NumPy')
+    self.box_rows = box_rows
+    self.box_cols = box_cols
+    self.size = size = box_rows*box_cols
+    givens = numpy.array(grids, dtype=numpy.int16).reshape(len(grids), size*size)
+    self.options = numpy.ones(givens.shape + (size,), dtype=bool)
+    given = givens > 0
+    self.options[given] = numpy.arange(1, size+1) == givens[given][:, None]
+    # cell indexes of each row, column and box, one (size, size) array each
+    cells = numpy.arange(size*size).reshape(size, size)
+    boxes = cells.reshape(size//box_rows, box_rows, size//box_cols, box_cols).transpose(0, 2, 1, 3).reshape(size, size)
+    self.units = [cells, cells.T, boxes]
+  def __len__(self):
+    return len(self.options)
+  def eliminate(self):
+    # Runs every elimination until no puzzle changes. Puzzles are dropped from
+    # the rounds once unchanged or broken.
+    live = numpy.arange(len(self.options))
+    while live.size:
+      options = self.options[live]
+      before = options.sum(axis=(1, 2))
+      self._singles(options)
+      self._hidden_singles(options)
+      self._pointing(options)
+      self.options[live] = options
+      counts = options.sum(axis=2)
+      changed = counts.sum(axis=1) < before
+      live = live[changed & (counts > 0).all(axis=1)]
+  def solved(self):
+    # Whether each puzzle has one option left in every cell. After
+    # 'eliminate', such puzzles are also consistent, since naked singles
+    # would otherwise have emptied a cell.
+    return (self.options.sum(axis=2) == 1).all(axis=1)
+  def broken(self):
+    return (~self.options.any(axis=2)).any(axis=1)
+  def cell_options(self, n):
+    # cell -> options of puzzle 'n', with cells as state.Sudoku's.
+    size = self.size
+    return {(i//size+1, i%size+1): [o+1 for o in numpy.flatnonzero(opts)] for i, opts in enumerate(self.options[n])}
+  def to_string(self, n, blank='.'):
+    # Puzzle 'n' as state.Sudoku.to_string writes it.
+    symbols = state.Sudoku.SYMBOLS
+    return ''.join(symbols[opts.argmax()] if opts.sum() == 1 else blank for opts in self.options[n])
+  def _singles(self, options):
+    # Rules out each solved cell's option from the rest of its units.
+    fixed = options & (options.sum(axis=2) == 1)[:, :, None]
+    for unit in self.units:
+      unit_fixed = fixed[:, unit]
+      seen = unit_fixed.sum(axis=2, keepdims=True)
+      options[:, unit] &= (seen - unit_fixed) == 0
+  def _hidden_singles(self, options):
+    # Solves each cell that is the only one in a unit with an option.
+    for unit in self.units:
+      unit_options = options[:, unit]
+      hidden = unit_options & (unit_options.sum(axis=2, keepdims=True) == 1)
+      options[:, unit] = numpy.where(hidden.any(axis=3, keepdims=True), hidden, unit_options)
+  def _pointing(self, options):
+    size, box_rows, box_cols = self.size, self.box_rows, self.box_cols
+    # (puzzles, bands, rows of a band, stacks, columns of a stack, options)
+    grid = options.reshape(len(options), size//box_rows, box_rows, size//box_cols, box_cols, size)
+    _point(grid)
+    # the same with columns as lines, as a view so changes write through
+    _point(grid.transpose(0, 3, 4, 1, 2, 5))
+
+def _point(grid):
+  # Pointing and claiming along the lines of 'grid', a (puzzles, bands of
+  # lines, lines of a band, boxes of a band, cells of a box's line, options)
+  # view, ruled out in place.
+  segments = grid.any(axis=4)
+  # an option in only one line of a box is ruled out from that line's other
+  # boxes
+  pointing = segments & (segments.sum(axis=2, keepdims=True) == 1)
+  ruled_out = (pointing.sum(axis=3, keepdims=True) - pointing) > 0
+  # an option in only one box of a line is ruled out from that box's other
+  # lines
+  claiming = segments & (segments.sum(axis=3, keepdims=True) == 1)
+  ruled_out |= (claiming.sum(axis=2, keepdims=True) - claiming) > 0
+  grid &= ~ruled_out[:, :, :, :, None, :]
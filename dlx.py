@@ -0,0 +1,128 @@
+import state
+
+class ExactCover:
+  """
+  A puzzle made only of OneEachConstraints, compiled into an exact cover
+  problem and solved with Knuth's Algorithm X. Columns are kept as a dict of
+  sets of rows, which gives the same cover/uncover steps as dancing links.
+
+  Each row is a (cell, option) pair still open in the puzzle. Each cell is a
+  column that must be covered exactly once. Each (constraint, option) pair is
+  a column too: it must be covered exactly once when the constraint has as
+  many options as cells, and at most once (a secondary column) otherwise.
+  """
+  def __init__(self, puzzle):
+    for name, constraint in puzzle.constraints.items():
+      if type(constraint) != state.OneEachConstraint:
+        raise ValueError('{} is not a OneEachConstraint'.format(name))
+    self._rows = {}
+    self._primary = set()
+    givens = []
+    for cid, opts in puzzle.cell_options.items():
+      self._primary.add(('cell', cid))
+      for opt in opts:
+        self._rows[(cid, opt)] = [('cell', cid)]
+      if len(opts) == 1:
+        givens.append((cid, opts[0]))
+    for name, constraint in puzzle.constraints.items():
+      options = set(constraint.options)
+      exact = len(options) == len(constraint.cells)
+      for opt in options:
+        if exact:
+          self._primary.add(('opt', name, opt))
+      for cid in constraint.cells:
+        for opt in puzzle.cell_options[cid]:
+          if opt in options:
+            self._rows[(cid, opt)].append(('opt', name, opt))
+    # rows are tried in the order the puzzle lists its cells and options
+    self._order = {row: i for i, row in enumerate(self._rows)}
+    self._columns = {}
+    for row, columns in self._rows.items():
+      for column in columns:
+        self._columns.setdefault(column, set()).add(row)
+    for opt_column in self._primary:
+      self._columns.setdefault(opt_column, set())
+    self._all_primary = len(self._columns) == len(self._primary)
+    self._givens = givens
+  def _select(self, row):
+    columns = self._columns
+    removed = []
+    for j in self._rows[row]:
+      for i in columns[j]:
+        for k in self._rows[i]:
+          if k != j:
+            columns[k].remove(i)
+      removed.append(columns.pop(j))
+    return removed
+  def _deselect(self, row, removed):
+    columns = self._columns
+    for j in reversed(self._rows[row]):
+      columns[j] = removed.pop()
+      for i in columns[j]:
+        for k in self._rows[i]:
+          if k != j:
+            columns[k].add(i)
+  def _search(self, partial):
+    columns = self._columns
+    if self._all_primary:
+      best = min(columns, key=lambda column: len(columns[column])) if columns else None
+    else:
+      best = None
+      for column in self._primary:
+        rows = columns.get(column)
+        if rows is not None and (best is None or len(rows) < len(columns[best])):
+          best = column
+    if best is None:
+      yield partial
+      return
+    for row in sorted(columns[best], key=self._order.__getitem__):
+      removed = self._select(row)
+      partial.append(row)
+      try:
+        yield from self._search(partial)
+      finally:
+        partial.pop()
+        self._deselect(row, removed)
+  def solutions(self):
+    """
+    Yields every solution, each as a dict of cell -> [option] like
+    'cell_options'.
+    """
+    selected = []
+    try:
+      for row in self._givens:
+        # a given already covered by another given conflicts with it
+        if any(column not in self._columns for column in self._rows[row]):
+          return
+        selected.append((row, self._select(row)))
+      for partial in self._search([]):
+        solution = {cid: [opt] for (cid, opt), _ in selected}
+        solution.update((cid, [opt]) for cid, opt in partial)
+        yield solution
+    finally:
+      for row, removed in reversed(selected):
+        self._deselect(row, removed)
+
+def iter_solutions(puzzle):
+  return ExactCover(puzzle).solutions()
+
+def solve(puzzle):
+  # Returns the first solution found, or None if there isn't one.
+  solutions = iter_solutions(puzzle)
+  try:
+    return next(solutions, None)
+  finally:
+    solutions.close()
+
+def count_solutions(puzzle, limit=None):
+  # Counts solutions, stopping early once 'limit' have been found.
+  count = 0
+  solutions = iter_solutions(puzzle)
+  try:
+    for _ in solutions:
+      count += 1
+      if limit is not None and count >= limit:
+        break
+  finally:
+    solutions.close()
+  return count
@@ -0,0 +1,264 @@
+import state
+import solver
+from solver import TIERS
+from state import popcount
+import argparse
+import random
+import sys
+
+# Cell orbits that givens are removed in, so puzzles keep the symmetry.
+SYMMETRIES = {
+  'none': lambda r, c, n: [(r, c)],
+  'rotational': lambda r, c, n: [(r, c), (n-1-r, n-1-c)],
+  'quarter': lambda r, c, n: [(r, c), (c, n-1-r), (n-1-r, n-1-c), (n-1-c, r)],
+  'mirror': lambda r, c, n: [(r, c), (r, n-1-c)],
+  'diagonal': lambda r, c, n: [(r, c), (c, r)],
+}
+
+class Shape:
+  """
+  The cells of a board of 'box_rows' x 'box_cols' boxes for the bitmask
+  search: grids are lists of options, row major with 0 for blank, and each
+  row, column and box keeps a mask of the options placed in it.
+  """
+  _shapes = {}
+  def __init__(self, box_rows, box_cols):
+    self.box_rows = box_rows
+    self.box_cols = box_cols
+    self.size = size = box_rows*box_cols
+    self.full = (1 << size)-1
+    cells = range(size*size)
+    self.row_of = [i//size for i in cells]
+    self.col_of = [i%size for i in cells]
+    self.box_of = [(i//size//box_rows)*box_rows + (i%size)//box_cols for i in cells]
+    self.rows = [[i for i in cells if self.row_of[i] == r] for r in range(size)]
+    self.cols = [[i for i in cells if self.col_of[i] == c] for c in range(size)]
+    self.boxes = [[i for i in cells if self.box_of[i] == b] for b in range(size)]
+  @classmethod
+  def get(cls, box_rows=3, box_cols=None):
+    key = (box_rows, box_cols or box_rows)
+    shape = cls._shapes.get(key)
+    if shape is None:
+      shape = cls._shapes[key] = cls(*key)
+    return shape
+  def orbits(self, symmetry):
+    # The cell orbits of 'symmetry', as lists of cell indexes, in order.
+    n = self.size
+    orbit_of = SYMMETRIES[symmetry]
+    seen = set()
+    orbits = []
+    for i in range(n*n):
+      if i in seen:
+        continue
+      orbit = sorted(set(r*n+c for r, c in orbit_of(i//n, i%n, n)))
+      seen.update(orbit)
+      orbits.append(orbit)
+    return orbits
+  def to_string(self, grid, blank='.'):
+    # As state.Sudoku.to_string writes it.
+    symbols = state.Sudoku.SYMBOLS
+    return ''.join(symbols[v-1] if v else blank for v in grid)
+
+def _search(shape, grid, limit, rng=None):
+  """
+  Fills the blank cells of 'grid' in place with the first solution found,
+  returning the number of solutions counted, up to 'limit'. Each step places
+  an option forced into a cell, or one that is the only place for an option
+  in a row, column or box, and otherwise tries each option of the cell with
+  the fewest, in random order with 'rng'.
+  """
+  size, full = shape.size, shape.full
+  row_of, col_of, box_of = shape.row_of, shape.col_of, shape.box_of
+  rows, cols, boxes = [0]*size, [0]*size, [0]*size
+  for i, v in enumerate(grid):
+    if v:
+      bit = 1 << (v-1)
+      r, c, b = row_of[i], col_of[i], box_of[i]
+      if (rows[r] | cols[c] | boxes[b]) & bit:
+        return 0
+      rows[r] |= bit
+      cols[c] |= bit
+      boxes[b] |= bit
+  # (options placed in the unit, unit index, cells) for each row, column, box
+  units = [(placed, index, cells) for placed, unit_cells in ((rows, shape.rows), (cols, shape.cols), (boxes, shape.boxes))
+    for index, cells in enumerate(unit_cells)]
+  masks = [0]*len(grid)
+  empty = [i for i, v in enumerate(grid) if not v]
+  solution = []
+  def search(n, limit):
+    if not n:
+      if not solution:
+        solution.extend(grid)
+      return 1
+    best_k, best_mask, best_count = 0, 0, size+1
+    for k in range(n):
+      i = empty[k]
+      mask = masks[i] = full & ~(rows[row_of[i]] | cols[col_of[i]] | boxes[box_of[i]])
+      if not mask:
+        return 0
+      count = popcount(mask)
+      if count < best_count:
+        best_k, best_mask, best_count = k, mask, count
+        if count == 1:
+          break
+    if best_count > 1:
+      for placed, index, cells in units:
+        once = twice = 0
+        for i in cells:
+          if not grid[i]:
+            m = masks[i]
+            twice |= once & m
+            once |= m
+        if full & ~placed[index] & ~once:
+          return 0
+        single = once & ~twice
+        if single:
+          best_mask = single & -single
+          best_k = empty.index(next(i for i in cells if not grid[i] and masks[i] & best_mask), 0, n)
+          break
+    empty[best_k], empty[n-1] = empty[n-1], empty[best_k]
+    i = empty[n-1]
+    r, c, b = row_of[i], col_of[i], box_of[i]
+    bits = []
+    while best_mask:
+      bit = best_mask & -best_mask
+      best_mask ^= bit
+      bits.append(bit)
+    if rng is not None:
+      rng.shuffle(bits)
+    found = 0
+    for bit in bits:
+      rows[r] |= bit
+      cols[c] |= bit
+      boxes[b] |= bit
+      grid[i] = bit.bit_length()
+      found += search(n-1, limit-found)
+      rows[r] ^= bit
+      cols[c] ^= bit
+      boxes[b] ^= bit
+      if found >= limit:
+        break
+    grid[i] = 0
+    return found
+  found = search(len(empty), limit)
+  if solution:
+    grid[:] = solution
+  return found
+
+def count_solutions(grid, box_rows=3, box_cols=None, limit=2):
+  """
+  Counts the solutions of 'grid' (a list of options, row major with 0 for
+  blank), stopping once 'limit' are found, so the default tells unique grids
+  from others as soon as a second solution turns up.
+  """
+  return _search(Shape.get(box_rows, box_cols), list(grid), limit)
+
+class Generator:
+  """
+  Makes unique-solution puzzles of 'box_rows' x 'box_cols' boxes: fills a
+  random grid, then removes givens one orbit of 'symmetry' at a time (see
+  SYMMETRIES) in random order, keeping each removal that leaves the solution
+  unique. With a 'tier', puzzles are graded by the hardest SudokuSolver
+  deducer they need (see 'grade'); those too hard get givens back until they
+  are easy enough, and those too easy are dropped.
+  """
+  def __init__(self, box_rows=3, box_cols=None, symmetry='rotational', seed=None, bifurcation_level=1,
+      grade_timeout=None):
+    self.shape = Shape.get(box_rows, box_cols)
+    self.orbits = self.shape.orbits(symmetry)
+    self.rng = random.Random(seed)
+    self.solver = solver.SudokuSolver(bifurcation_level=bifurcation_level)
+    self.grade_timeout = grade_timeout
+    # reused for every grade, rolled back to empty in between
+    self._puzzle = state.Sudoku(compact=True, box_rows=self.shape.box_rows, box_cols=self.shape.box_cols)
+  def full_grid(self):
+    grid = [0]*(self.shape.size**2)
+    _search(self.shape, grid, 1, self.rng)
+    return grid
+  def dig(self, solution):
+    # Returns a copy of 'solution' with as many orbits of givens removed as
+    # keep the solution unique.
+    grid = list(solution)
+    orbits = list(self.orbits)
+    self.rng.shuffle(orbits)
+    for orbit in orbits:
+      for i in orbit:
+        grid[i] = 0
+      if _search(self.shape, list(grid), 2) != 1:
+        for i in orbit:
+          grid[i] = solution[i]
+    return grid
+  def grade(self, grid):
+    # The tier of the hardest deducer the solver needs for 'grid', or None if
+    # it can't solve it (in 'grade_timeout' seconds).
+    puzzle = self._puzzle
+    size = self.shape.size
+    used = set()
+    puzzle.checkpoint()
+    try:
+      puzzle.load_from_list([grid[r*size:(r+1)*size] for r in range(size)])
+      result = self.solver.solve(puzzle, timeout=self.grade_timeout, step=lambda name, deduction: used.add(name))
+    finally:
+      puzzle.rollback()
+    if result.reason != 'solved':
+      return None
+    return max((solver.tier_of(name) for name in used), key=TIERS.index, default=TIERS[0])
+  def generate(self, tier=None, attempts=100):
+    """
+    Returns a puzzle as a grid string (see state.Sudoku.from_string), of
+    'tier' if given, or None if 'attempts' full grids give none.
+    """
+    for _ in range(attempts):
+      solution = self.full_grid()
+      grid = self.dig(solution)
+      if tier is None:
+        return self.shape.to_string(grid)
+      grid = self._ease(grid, solution, tier)
+      if grid is not None:
+        return self.shape.to_string(grid)
+    return None
+  def _ease(self, grid, solution, tier):
+    # Puts givens back, an orbit at a time, until 'grid' is no harder than
+    # 'tier'. Returns it if then of 'tier', or None.
+    rank = TIERS.index(tier)
+    grade = self.grade(grid)
+    removed = [orbit for orbit in self.orbits if not grid[orbit[0]]]
+    self.rng.shuffle(removed)
+    while grade is None or TIERS.index(grade) > rank:
+      if not removed:
+        return None
+      for i in removed.pop():
+        grid[i] = solution[i]
+      grade = self.grade(grid)
+    return grid if grade == tier else None
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Generate unique-solution sudoku puzzles.')
+  parser.add_argument('-n', '--count', type=int, default=1, help='puzzles to generate')
+  parser.add_argument('-t', '--tier', choices=TIERS, help='difficulty tier to generate')
+  parser.add_argument('--box-rows', type=int, default=3)
+  parser.add_argument('--box-cols', type=int, default=None, help='default: the same as --box-rows')
+  parser.add_argument('-s', '--symmetry', default='rotational', choices=sorted(SYMMETRIES))
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('-b', '--bifurcation', type=int, default=1, help='bifurcation level to grade with')
+  parser.add_argument('--grade-timeout', type=float, default=None, help='seconds to grade a puzzle for')
+  parser.add_argument('--attempts', type=int, default=100, help='full grids to try per puzzle of a --tier')
+  parser.add_argument('-o', '--output', default='-', help='output file, or - for stdout')
+  args = parser.parse_args(argv)
+  generator = Generator(args.box_rows, args.box_cols, symmetry=args.symmetry, seed=args.seed,
+    bifurcation_level=args.bifurcation, grade_timeout=args.grade_timeout)
+  outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+  try:
+    for _ in range(args.count):
+      grid = generator.generate(args.tier, attempts=args.attempts)
+      if grid is None:
+        sys.exit('No {} puzzle found in {} attempts'.format(args.tier, args.attempts))
+      outfile.write(grid)
+      outfile.write('\n')
+      outfile.flush()
+  finally:
+    if outfile is not sys.stdout:
+      outfile.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,92 @@
+import solver
+from state import popcount
+
+def get_search_solver():
+  # The cheap deducers used to propagate after each guess.
+  search_solver = solver.Solver()
+  search_solver.deducers.append(solver.get_only_opt_deducer())
+  search_solver.deducers.append(solver.get_constraint_violation_deducer())
+  return search_solver
+
+def propagate(puzzle, base_solver):
+  # Makes deductions until none are left or the puzzle is solved, returning
+  # False if it ran into a contradiction. Constraints are only checked once
+  # deduction stops, as a broken puzzle soon runs out of options anyway.
+  while not puzzle.broken():
+    if puzzle.free_cells() == 0 or not base_solver.make_deduction(puzzle):
+      return puzzle.constraints_satisfied()
+  return False
+
+def choose_cell(puzzle):
+  # Returns the unsolved cell with the fewest options (the first one, on a
+  # tie), or None if every cell is solved.
+  best, best_count = None, None
+  bitset = puzzle.bitset
+  if bitset is not None:
+    cells = bitset.cells
+    for i, m in enumerate(bitset.masks):
+      if m & (m-1):
+        count = popcount(m)
+        if best_count is None or count < best_count:
+          best, best_count = cells[i], count
+          if count == 2:
+            break
+    return best
+  for cid, opts in puzzle.cell_options.items():
+    if len(opts) > 1 and (best_count is None or len(opts) < best_count):
+      best, best_count = cid, len(opts)
+      if best_count == 2:
+        break
+  return best
+
+def _search(puzzle, base_solver):
+  if not propagate(puzzle, base_solver):
+    return
+  cid = choose_cell(puzzle)
+  if cid is None:
+    yield {c: list(opts) for c, opts in puzzle.cell_options.items()}
+    return
+  for opt in puzzle.cell_options[cid]:
+    puzzle.checkpoint()
+    try:
+      puzzle.cell_options[cid] = [opt]
+      yield from _search(puzzle, base_solver)
+    finally:
+      puzzle.rollback()
+
+def iter_solutions(puzzle, base_solver=None):
+  """
+  Yields every solution of the puzzle, each as a dict of cell -> [option] like
+  'cell_options'. This is a complete backtracking search: after propagating
+  with 'base_solver' (see 'get_search_solver'), it guesses each option of the
+  cell with the fewest remaining and recurses. The puzzle is left unchanged
+  once the generator is exhausted or closed.
+  """
+  if base_solver is None:
+    base_solver = get_search_solver()
+  puzzle.checkpoint()
+  try:
+    yield from _search(puzzle, base_solver)
+  finally:
+    puzzle.rollback()
+
+def solve(puzzle, base_solver=None):
+  # Returns the first solution found, or None if there isn't one.
+  solutions = iter_solutions(puzzle, base_solver)
+  try:
+    return next(solutions, None)
+  finally:
+    solutions.close()
+
+def count_solutions(puzzle, limit=None, base_solver=None):
+  # Counts solutions, stopping early once 'limit' have been found.
+  count = 0
+  solutions = iter_solutions(puzzle, base_solver)
+  try:
+    for _ in solutions:
+      count += 1
+      if limit is not None and count >= limit:
+        break
+  finally:
+    solutions.close()
+  return count
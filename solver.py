@@ -1,25 +1,168 @@
 import state
+from state import popcount
 from functools import partial
+import collections
+import concurrent.futures
+import itertools
+import json
+import os
 import re
+import struct
+import sys
+import threading
+import time
+import weakref
 
 class Solver:
-  def __init__(self):
+  def __init__(self, propagate=True, schedule=None):
     # (str, func(puzzle))
     self._deducers = []
     self._disabled_deducers = []
+    # When propagating, deducers are not re-run on parts of a puzzle that are
+    # unchanged since they last came up empty.
+    # puzzle -> {deducer: puzzle version or {constraint_name: (constraint, version)}}
+    self._propagate = propagate
+    self._clean = weakref.WeakKeyDictionary()
+    # a Profile to record deducer calls in, or None
+    self.profile = None
+    # a Schedule to order deducers by, or None to always try them in the order
+    # they were added, which keeps the deductions made (and so explanations)
+    # the same from run to run
+    self.schedule = schedule
+    # the number of deducers, from the first, that a schedule leaves in place:
+    # those the others rely on having run first
+    self.pinned_deducers = 0
   def _disable_after(self, deducer_name):
     for disabled in self._disabled_deducers:
       if re.match(disabled, deducer_name):
         return True
     return False
   def make_deduction(self, puzzle):
-    for deducer_name, deducer in self._deducers:
+    # derived constraints are dropped once they add nothing, so they don't
+    # slow every later step
+    puzzle.retire_constraints()
+    profile = self.profile
+    # trials in Odd Wing and Bifurcation (run with deducers disabled) keep the
+    # fixed order, which their depth limits are tuned for, and aren't learnt
+    # from
+    schedule = self.schedule if not self._disabled_deducers else None
+    labels = None
+    if profile is not None or schedule is not None:
+      labels = self.deducer_labels()
+    order = range(len(self._deducers))
+    if schedule is not None:
+      enabled = 0
+      for deducer_name, _ in self._deducers:
+        if self._disable_after(deducer_name):
+          break
+        enabled += 1
+      pinned = min(self.pinned_deducers, enabled)
+      order = list(range(pinned)) + [pinned+i for i in schedule.order(labels[pinned:enabled])]
+    if self._propagate:
+      clean = self._clean.setdefault(puzzle, {})
+      # constraint versions are shared by the deducers below, since the puzzle
+      # doesn't change until one of them makes a deduction
+      versions = {}
+    for i in order:
+      deducer_name, deducer = self._deducers[i]
       if self._disable_after(deducer_name):
         break
-      deduction = deducer(puzzle)
+      check_budget()
+      seen = None
+      if not self._propagate:
+        func, args = deducer, (puzzle,)
+      elif getattr(deducer, 'per_constraint', False):
+        func, args = self._propagate_constraints, (puzzle, deducer, clean.setdefault(deducer, {}), versions)
+      else:
+        seen = (puzzle.version(), tuple(self._disabled_deducers))
+        if clean.get(deducer) == seen:
+          continue
+        func, args = deducer, (puzzle,)
+      if labels is None:
+        deduction = func(*args)
+      else:
+        deduction = self._run(labels[i], puzzle, func, args, schedule)
       if deduction:
         return deducer_name, deduction
+      if seen is not None:
+        clean[deducer] = seen
+    return None
+  def solve(self, puzzle, timeout=None, max_steps=None, max_nodes=None, step=None):
+    """
+    Makes deductions until the puzzle is solved, broken or stuck, or the
+    budget runs out: 'timeout' seconds of wall clock time, 'max_steps'
+    deductions, or 'max_nodes' checks made by the deducers as they search
+    (each trial, chain, fish or tuple candidate and so on is one). Deducers
+    check the budget as they go, and one stopped part way leaves the puzzle
+    and 'disabled_deducers' as they were before it started, so the puzzle
+    holds every deduction made. 'step(deducer_name, deduction)' is called
+    after each one if given. Returns a SolveResult.
+    """
+    outer = getattr(_active, 'budget', None)
+    _active.budget = Budget(timeout, max_nodes)
+    deductions = []
+    start = time.perf_counter()
+    try:
+      while True:
+        if puzzle.broken():
+          reason = 'broken'
+        elif puzzle.free_cells() == 0:
+          reason = 'solved' if puzzle.constraints_satisfied() else 'broken'
+        elif max_steps is not None and len(deductions) >= max_steps:
+          reason = 'steps'
+        else:
+          try:
+            deduction = self.make_deduction(puzzle)
+          except BudgetExceeded as e:
+            reason = e.reason
+          else:
+            if deduction:
+              deductions.append(deduction)
+              if step is not None:
+                step(*deduction)
+              continue
+            reason = 'stuck'
+        break
+    finally:
+      _active.budget = outer
+    return SolveResult(reason, deductions, {cid: list(opts) for cid, opts in puzzle.cell_options.items()},
+      time.perf_counter()-start)
+  def _run(self, label, puzzle, func, args, schedule):
+    if schedule is None:
+      return self.profile.run(label, puzzle, func, *args)
+    start = time.perf_counter()
+    if self.profile is None:
+      deduction = func(*args)
+    else:
+      deduction = self.profile.run(label, puzzle, func, *args)
+    schedule.record(label, deduction, time.perf_counter()-start)
+    return deduction
+  def _propagate_constraints(self, puzzle, deducer, clean, versions):
+    # Runs a per-constraint deducer on a work queue of the constraints whose
+    # cells have changed since it last checked them, in constraint order.
+    queue = []
+    for name, constraint in puzzle.constraints.items():
+      version = versions.get(name)
+      if version is None:
+        version = versions[name] = puzzle.version(constraint)
+      seen = clean.get(name)
+      if seen is None or seen[0] is not constraint or seen[1] != version:
+        queue.append((name, constraint, version))
+    for name, constraint, version in queue:
+      deduction = deducer(puzzle, [(name, constraint)])
+      if deduction:
+        return deduction
+      clean[name] = (constraint, version)
     return None
+  def deducer_labels(self):
+    # Deducer names, numbered where several deducers share one.
+    names = [name for name, _ in self._deducers]
+    labels = []
+    for i, name in enumerate(names):
+      if names.count(name) > 1:
+        name = '{} #{}'.format(name, names[:i].count(name)+1)
+      labels.append(name)
+    return labels
   @property
   def deducers(self):
     return self._deducers
@@ -28,78 +171,661 @@ class Solver:
     return self._disabled_deducers
 
 class Deduction:
-  def __init__(self, name, cells_affected):
-    self.name = name
+  """
+  What a deducer found: the 'cells_affected', and the 'kind' of deduction
+  with the 'options', 'constraints' and so on it was made from as keyword
+  fields. Its message ('name') is only formatted when it is asked for, from
+  the kind's entry in MESSAGES, since most deductions (those made in trials)
+  are never shown. A kind without an entry is its own message.
+  """
+  MESSAGES = {
+    'ruled out': '{options} ruled out',
+    'naked single': 'Naked single, {options}',
+    'only cell': 'Only one cell for {options} in {constraints}',
+    'tuple': 'Found {constraints}',
+    'hidden tuple': 'Found hidden {constraints}',
+    'fish': '({side}) Ruled out {options} from cells in {constraints} but not {excluding}',
+    'chain': 'Chain of length {length} ruled out {options}',
+    'odd wing': 'For every option ({options}) in {cells}, ruled out {ruled_out} from cells respectively.',
+  }
+  def __init__(self, kind, cells_affected, **fields):
+    self.kind = kind
     self.cells_affected = cells_affected
+    self.fields = fields
+    self._name = None
+  @property
+  def name(self):
+    if self._name is None:
+      message = self.MESSAGES.get(self.kind)
+      self._name = self.kind if message is None else message.format(**self.fields)
+    return self._name
   def __str__(self):
     return '{}. Affected {}'.format(self.name, self.cells_affected)
 
-def get_bifurcation_deducer(base_solver, max_depth):
-  def recursive_deduce(puzzle, depth, max_depth):
+class DeducerStats:
+  def __init__(self):
+    self.calls = 0
+    self.hits = 0
+    self.time = 0.0
+    self.max_time = 0.0
+    self.cells_affected = 0
+  def to_dict(self):
+    return {
+      'calls': self.calls,
+      'hits': self.hits,
+      'time': self.time,
+      'max_time': self.max_time,
+      'cells_affected': self.cells_affected,
+    }
+
+class Profile:
+  """
+  Records every deducer a Solver runs while it is set as the solver's
+  'profile'. Stats are kept per path of deducer labels, so a deducer run by
+  another (the Odd Wing and Bifurcation deducers run their base solver on
+  trial puzzles) is counted under its parent's path, e.g.
+  ('Odd Wing (5, 2)', 'Pointy-Fish #1'), and not with the top level calls.
+  Times are inclusive of any nested calls.
+
+  'before(path, puzzle)' and 'after(path, puzzle, deduction, seconds)' are
+  called around each deducer if given.
+  """
+  def __init__(self, before=None, after=None):
+    self.before = before
+    self.after = after
+    # (label, ...) -> DeducerStats
+    self.stats = {}
+    self._path = ()
+  def run(self, label, puzzle, func, *args):
+    parent = self._path
+    path = self._path = parent + (label,)
+    if self.before is not None:
+      self.before(path, puzzle)
+    deduction = None
+    start = time.perf_counter()
+    try:
+      deduction = func(*args)
+    finally:
+      elapsed = time.perf_counter()-start
+      self._path = parent
+      stats = self.stats.get(path)
+      if stats is None:
+        stats = self.stats[path] = DeducerStats()
+      stats.calls += 1
+      stats.time += elapsed
+      if elapsed > stats.max_time:
+        stats.max_time = elapsed
+      if deduction:
+        stats.hits += 1
+        stats.cells_affected += len(deduction.cells_affected)
+    if self.after is not None:
+      self.after(path, puzzle, deduction, elapsed)
+    return deduction
+  def totals(self):
+    # {label: DeducerStats} for the deducers run at the top level.
+    return {path[0]: stats for path, stats in self.stats.items() if len(path) == 1}
+  def reset(self):
+    self.stats = {}
+  def report(self, out=sys.stdout, max_depth=None):
+    out.write('{:<40} {:>8} {:>6} {:>10} {:>10} {:>6}\n'.format('deducer', 'calls', 'hits', 'ms', 'max ms', 'cells'))
+    for path in sorted(self.stats):
+      if max_depth is not None and len(path) > max_depth:
+        continue
+      stats = self.stats[path]
+      out.write('{:<40} {:>8} {:>6} {:>10.1f} {:>10.1f} {:>6}\n'.format(
+        '  '*(len(path)-1)+path[-1], stats.calls, stats.hits, 1000*stats.time, 1000*stats.max_time, stats.cells_affected))
+
+class Schedule:
+  """
+  Orders a solver's deducers to find the next deduction in the least expected
+  time: each is tried in increasing order of its mean time per call divided by
+  its hit rate. Hit rates are smoothed, so a deducer is not written off after
+  a few misses. Deducers that have not been called yet go after the others,
+  in the solver's order, so one that is rarely needed is in effect skipped
+  until everything else comes up empty.
+
+  Only the deducers after the solver's 'pinned_deducers' are reordered, and
+  only at the top level: the solves inside Odd Wing and Bifurcation trials
+  keep the solver's order. Stats are learnt from top level calls while 'learn'
+  is set, and can be seeded from a saved schedule or a Profile. Which deductions are made,
+  and in what order, depends on timings, so they can differ from run to run.
+  """
+  def __init__(self, stats=None, learn=True):
+    # label -> [calls, hits, seconds]
+    self.stats = {}
+    for label, s in (stats or {}).items():
+      self.stats[label] = [s['calls'], s['hits'], s['time']]
+    self.learn = learn
+  @classmethod
+  def from_profile(cls, profile, learn=True):
+    return cls({label: stats.to_dict() for label, stats in profile.totals().items()}, learn=learn)
+  @classmethod
+  def load(cls, path, learn=True):
+    with open(path) as f:
+      return cls(json.load(f), learn=learn)
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.to_dict(), f, indent=2)
+  def to_dict(self):
+    return {label: {'calls': calls, 'hits': hits, 'time': seconds} for label, (calls, hits, seconds) in self.stats.items()}
+  def cost(self, label):
+    # Expected seconds spent in the deducer per deduction it makes, or None if
+    # it hasn't been called.
+    stats = self.stats.get(label)
+    if not stats or not stats[0]:
+      return None
+    calls, hits, seconds = stats
+    return seconds/calls * (calls+2)/(hits+1)
+  def order(self, labels):
+    # The indexes of 'labels' in the order to try them.
+    costs = [self.cost(label) for label in labels]
+    known = sorted((i for i, cost in enumerate(costs) if cost is not None), key=costs.__getitem__)
+    return known + [i for i, cost in enumerate(costs) if cost is None]
+  def record(self, label, deduction, seconds):
+    if not self.learn:
+      return
+    stats = self.stats.get(label)
+    if stats is None:
+      stats = self.stats[label] = [0, 0, 0.0]
+    stats[0] += 1
+    if deduction:
+      stats[1] += 1
+    stats[2] += seconds
+
+class BudgetExceeded(Exception):
+  # Raised by check_budget when the budget of the solve running has run out,
+  # with the 'reason': 'deadline' or 'nodes'.
+  def __init__(self, reason):
+    super().__init__(reason)
+    self.reason = reason
+
+class Budget:
+  """
+  The limits of a Solver.solve: 'timeout' seconds from when it is made, and
+  'max_nodes' calls to 'check', either None for no limit. The deadline is
+  kept on the monotonic clock, so changes to the system clock don't move it.
+  """
+  def __init__(self, timeout=None, max_nodes=None):
+    self.deadline = None if timeout is None else time.monotonic()+timeout
+    self.max_nodes = max_nodes
+    self.nodes = 0
+  def remaining(self):
+    # Seconds left before the deadline, or None.
+    return None if self.deadline is None else self.deadline-time.monotonic()
+  def wall_deadline(self):
+    # The deadline as time.time() gives it, to send to other processes, whose
+    # monotonic clocks may differ, or None.
+    remaining = self.remaining()
+    return None if remaining is None else time.time()+remaining
+  def check(self):
+    self.nodes += 1
+    if self.max_nodes is not None and self.nodes > self.max_nodes:
+      raise BudgetExceeded('nodes')
+    if self.deadline is not None and time.monotonic() > self.deadline:
+      raise BudgetExceeded('deadline')
+
+# The Budget of the Solver.solve running in this process, if any. Deducers
+# aren't tied to a solver, so they reach it through check_budget. It is kept
+# per thread, so solves in different threads each have their own.
+_active = threading.local()
+
+def check_budget():
+  # Called by deducers as they search, and raises BudgetExceeded once the
+  # budget of the solve running has run out.
+  budget = getattr(_active, 'budget', None)
+  if budget is not None:
+    budget.check()
+
+class SolveResult:
+  """
+  What Solver.solve did: the 'reason' it stopped ('solved', 'broken',
+  'stuck' when no deducer could go further, or 'deadline', 'steps' or 'nodes'
+  when the budget ran out), the (deducer name, Deduction) 'deductions' made
+  in order, the candidates left as 'cell_options' (cell -> options), and the
+  'time' taken in seconds.
+  """
+  STOPPED = ('deadline', 'steps', 'nodes')
+  def __init__(self, reason, deductions, cell_options, seconds):
+    self.reason = reason
+    self.deductions = deductions
+    self.cell_options = cell_options
+    self.time = seconds
+  @property
+  def stopped(self):
+    # True if the budget ran out before the solve finished
+    return self.reason in self.STOPPED
+
+_trace_layouts = weakref.WeakKeyDictionary()
+
+def trace_layout(puzzle):
+  # The state.BitsetCellOptions whose cell order and option bits number the
+  # cells and options in a puzzle's trace records.
+  layout = puzzle.bitset
+  if layout is not None:
+    return layout
+  layout = _trace_layouts.get(puzzle)
+  if layout is None:
+    topology = puzzle.topology
+    layout = topology.bitset() if topology is not None else state.BitsetCellOptions(puzzle.cell_options)
+    _trace_layouts[puzzle] = layout
+  return layout
+
+def trace_record(puzzle, deducer_name, deduction, messages=False):
+  # (deducer name, kind, [(cell index, options mask)], message or None) for a
+  # step just made on 'puzzle', for a TraceWriter to write.
+  layout = trace_layout(puzzle)
+  index = layout.index
+  if layout is puzzle.bitset:
+    masks = layout.masks
+    cells = [(index[cid], masks[index[cid]]) for cid in deduction.cells_affected]
+  else:
+    cells = [(index[cid], layout.encode(puzzle.cell_options[cid])) for cid in deduction.cells_affected]
+  return deducer_name, deduction.kind, cells, deduction.name if messages else None
+
+_TRACE_LENGTH = struct.Struct('<H')
+_TRACE_STEP = struct.Struct('<HHH')
+_TRACE_CELL = struct.Struct('<HQ')
+
+class TraceWriter:
+  """
+  Streams the steps of solves to 'out' as they are made, one record per
+  deduction, each with the deducer's name, the deduction's kind and the
+  cells affected as (cell index, options mask) after the step, numbered as
+  in trace_layout. Deduction messages are only formatted with 'messages'.
+
+  'fmt' is 'jsonl' for a JSON object per step, or 'binary' (with 'out' open
+  in binary mode) for tagged little-endian records: 'S' and a uint16 length
+  of UTF-8 defines the next string id, 'P' starts a puzzle, and 'D' is a step
+  of uint16 deducer and kind string ids and cell count, then a uint16 index
+  and uint64 mask per cell. Binary traces don't hold messages, and are read
+  back by read_binary_trace.
+  """
+  def __init__(self, out, fmt='jsonl', messages=False):
+    if fmt not in ('jsonl', 'binary'):
+      raise ValueError('Unknown trace format {}'.format(fmt))
+    self.out = out
+    self.fmt = fmt
+    self.messages = messages
+    self.puzzles = 0
+    self.steps = 0
+    # string -> id, for binary traces
+    self._strings = {}
+  def start(self):
+    # Starts the next puzzle's steps.
+    self.puzzles += 1
+    self.steps = 0
+    if self.fmt == 'binary':
+      self.out.write(b'P')
+  def step(self, puzzle, deducer_name, deduction):
+    self.write(trace_record(puzzle, deducer_name, deduction, self.messages))
+  def write(self, record):
+    # Writes a record from trace_record, which may have been made in another
+    # process.
+    deducer_name, kind, cells, message = record
+    self.steps += 1
+    if self.fmt == 'jsonl':
+      out = {'puzzle': self.puzzles, 'step': self.steps, 'deducer': deducer_name, 'kind': kind, 'cells': cells}
+      if message is not None:
+        out['message'] = message
+      self.out.write(json.dumps(out))
+      self.out.write('\n')
+      return
+    deducer_id, kind_id = self._string(deducer_name), self._string(kind)
+    parts = [b'D', _TRACE_STEP.pack(deducer_id, kind_id, len(cells))]
+    parts.extend(_TRACE_CELL.pack(i, mask) for i, mask in cells)
+    self.out.write(b''.join(parts))
+  def _string(self, string):
+    string_id = self._strings.get(string)
+    if string_id is None:
+      string_id = self._strings[string] = len(self._strings)
+      data = string.encode('utf-8')
+      self.out.write(b'S' + _TRACE_LENGTH.pack(len(data)) + data)
+    return string_id
+
+def read_binary_trace(f):
+  """
+  Yields the steps of a binary trace as dicts like TraceWriter's JSONL
+  records.
+  """
+  strings = []
+  puzzle = step = 0
+  while True:
+    tag = f.read(1)
+    if not tag:
+      return
+    if tag == b'S':
+      length, = _TRACE_LENGTH.unpack(f.read(_TRACE_LENGTH.size))
+      strings.append(f.read(length).decode('utf-8'))
+    elif tag == b'P':
+      puzzle += 1
+      step = 0
+    elif tag == b'D':
+      deducer_id, kind_id, count = _TRACE_STEP.unpack(f.read(_TRACE_STEP.size))
+      cells = [list(cell) for cell in _TRACE_CELL.iter_unpack(f.read(count*_TRACE_CELL.size))]
+      step += 1
+      yield {'puzzle': puzzle, 'step': step, 'deducer': strings[deducer_id], 'kind': strings[kind_id], 'cells': cells}
+    else:
+      raise ValueError('Unknown trace record {!r}'.format(tag))
+
+# Each TrialPool worker builds one solver and puzzle up front and loads the
+# puzzle of each trial it is sent into the same PuzzleState.
+_trial_solver = None
+_trial_puzzle = None
+
+def _init_trial_worker(solver_factory):
+  global _trial_solver, _trial_puzzle
+  _trial_solver = solver_factory()
+  _trial_puzzle = state.PuzzleState()
+
+def _run_trial(deducer_name, method, data, disabled, args, deadline):
+  puzzle = _trial_puzzle
+  puzzle.load(data)
+  _trial_solver.disabled_deducers[:] = disabled
+  deducer = next(deducer for name, deducer in _trial_solver.deducers if name == deducer_name)
+  # trials stop at the deadline of the solve that sent them (as wall clock
+  # time), however long they waited in the queue
+  _active.budget = Budget(None if deadline is None else deadline-time.time())
+  try:
+    return getattr(deducer, method)(puzzle, *args)
+  finally:
+    _active.budget = None
+
+class TrialPool:
+  """
+  A process pool that the Bifurcation and Odd Wing deducers can send their
+  trials to. Each worker makes its own solver with 'solver_factory', which
+  should give the same deducers as the solver using the pool (but without a
+  pool), and runs trials on a copy of the puzzle sent as 'PuzzleState.save'
+  data. Workers are started on first use.
+  """
+  def __init__(self, solver_factory, workers=None):
+    self.workers = workers or os.cpu_count()
+    self._solver_factory = solver_factory
+    self._executor = None
+  def map(self, deducer_name, method, puzzle, disabled, trials):
+    """
+    Yields the result of calling 'method' of the deducer named 'deducer_name'
+    on the puzzle with each of 'trials' as arguments, in order. Trials are run
+    at most two per worker ahead of the one being waited for, and those not
+    yet started are cancelled when the generator is closed. Trials share the
+    deadline of the solve running, if any, and a trial that runs past it
+    raises BudgetExceeded here.
+    """
+    if self._executor is None:
+      self._executor = concurrent.futures.ProcessPoolExecutor(
+        self.workers, initializer=_init_trial_worker, initargs=(self._solver_factory,))
+    data = puzzle.save()
+    disabled = list(disabled)
+    budget = getattr(_active, 'budget', None)
+    deadline = budget.wall_deadline() if budget is not None else None
+    trials = iter(trials)
+    pending = collections.deque()
+    try:
+      while True:
+        for args in itertools.islice(trials, 2*self.workers-len(pending)):
+          pending.append(self._executor.submit(_run_trial, deducer_name, method, data, disabled, args, deadline))
+        if not pending:
+          return
+        timeout = None if deadline is None else max(0, budget.remaining())
+        try:
+          result = pending.popleft().result(timeout)
+        except concurrent.futures.TimeoutError:
+          raise BudgetExceeded('deadline')
+        yield result
+    finally:
+      for future in pending:
+        future.cancel()
+  def close(self):
+    if self._executor is not None:
+      self._executor.shutdown(cancel_futures=True)
+      self._executor = None
+
+class TrialCache:
+  """
+  What bifurcation trials have found, so they aren't repeated. Trials are
+  recorded per (cell, option) with the candidates of every cell when they
+  started, and deductions only rule out options that are in no solution, so:
+  - a refuted trial is a nogood: it is refuted again from any state with no
+    candidates its start didn't have.
+  - a consistent trial settled in a state holding every solution with the
+    cell locked to the option. From a state with no candidates its start
+    didn't have, a rerun can start from that settled state (less the options
+    ruled out since), and if no candidate of it has been ruled out since, it
+    would settle there again with as many levels of bifurcation, so is
+    skipped.
+  The least recently used records are evicted once there are more than
+  'max_records'.
+  """
+  MAX_RECORDS_PER_TRIAL = 4
+  def __init__(self, max_records=1024):
+    self.max_records = max_records
+    # (cid, opt) -> [(levels, start, settled)], with 'settled' None if refuted
+    self._records = {}
+    self._count = 0
+    self._index = None
+  def state(self, puzzle):
+    # The candidates of every cell, as the records keep them. In compact mode
+    # the masks are packed into one integer, so states compare in one step.
+    bitset = puzzle.bitset
+    if bitset is not None:
+      width = len(bitset.options)
+      packed = 0
+      for m in reversed(bitset.masks):
+        packed = packed << width | m
+      return packed
+    return tuple(frozenset(opts) for opts in puzzle.cell_options.values())
+  def _check_index(self, puzzle):
+    # states are compared cell by cell, so are only valid for one cell order
+    bitset = puzzle.bitset
+    index = bitset.index if bitset is not None else tuple(puzzle.cell_options.keys())
+    if index is not self._index and index != self._index:
+      self._records = {}
+      self._count = 0
+      self._index = index
+  def _within(self, a, b):
+    # True if state 'a' has no candidates that state 'b' doesn't
+    if isinstance(a, int):
+      return a & ~b == 0
+    return all(x <= y for x, y in zip(a, b))
+  def lookup(self, puzzle, cid, opt, levels, state):
+    """
+    Returns (refuted, settled) for locking 'cid' to 'opt' in 'state', the
+    puzzle's current state. 'refuted' is True or False if the outcome with
+    'levels' of bifurcation is known, or None, with 'settled' a state to
+    resume the trial from if there is one.
+    """
+    self._check_index(puzzle)
+    records = self._records.pop((cid, opt), None)
+    if records is None:
+      return None, None
+    self._records[(cid, opt)] = records
+    # the latest record that applies has the most to go on
+    for record_levels, start, settled in reversed(records):
+      if not self._within(state, start):
+        continue
+      if settled is None:
+        return True, None
+      if record_levels >= levels and self._within(settled, state):
+        return False, None
+      return None, settled
+    return None, None
+  def record(self, puzzle, cid, opt, levels, start, settled):
+    self._check_index(puzzle)
+    records = self._records.pop((cid, opt), [])
+    records.append((levels, start, settled))
+    self._records[(cid, opt)] = records
+    self._count += 1
+    if len(records) > self.MAX_RECORDS_PER_TRIAL:
+      records.pop(0)
+      self._count -= 1
+    while self._count > self.max_records:
+      key = next(iter(self._records))
+      oldest = self._records[key]
+      oldest.pop(0)
+      self._count -= 1
+      if not oldest:
+        del self._records[key]
+
+def _restrict(puzzle, settled):
+  # Rules out of each cell the options that 'settled' doesn't have.
+  bitset = puzzle.bitset
+  if bitset is not None:
+    width = len(bitset.options)
+    full = (1 << width)-1
+    cells = bitset.cells
+    for i, m in enumerate(bitset.masks):
+      keep = settled >> width*i & full
+      if m & ~keep:
+        puzzle.cell_options[cells[i]] = bitset.decode(m & keep)
+    return
+  for (cid, opts), keep in zip(list(puzzle.cell_options.items()), settled):
+    if any(opt not in keep for opt in opts):
+      puzzle.cell_options[cid] = [opt for opt in opts if opt in keep]
+
+def get_bifurcation_deducer(base_solver, max_depth, max_records=1024, pool=None):
+  # puzzle -> TrialCache, kept across calls
+  caches = weakref.WeakKeyDictionary()
+  def get_cache(puzzle):
+    cache = caches.get(puzzle)
+    if cache is None:
+      cache = caches[puzzle] = TrialCache(max_records)
+    return cache
+  def trial(puzzle, cid, opt, depth, max_depth, settled):
+    # Locks 'cid' to 'opt' and deduces as far as possible, starting from the
+    # 'settled' state of an earlier trial if given. Returns the state the
+    # puzzle settled in, or None if it broke.
+    cache = get_cache(puzzle)
+    puzzle.checkpoint()
+    try:
+      puzzle.cell_options[cid] = [opt]
+      if settled is not None:
+        _restrict(puzzle, settled)
+      deduction = True
+      while deduction and not puzzle.broken() and puzzle.constraints_satisfied():
+        deduction = base_solver.make_deduction(puzzle) 
+        if not deduction:
+          deduction = recursive_deduce(puzzle, depth+1, max_depth, cache)
+      if puzzle.broken() or not puzzle.constraints_satisfied():
+        return None
+      return cache.state(puzzle)
+    finally:
+      puzzle.rollback()
+  def outcomes(puzzle, trials, depth, max_depth, cache, start):
+    # Yields (cid, opt, refuted) for each of 'trials', in order. Trials the
+    # cache doesn't know the outcome of are run here, or sent to the pool at
+    # the top level.
+    levels = max_depth-depth
+    known = [cache.lookup(puzzle, cid, opt, levels, start) for cid, opt in trials]
+    if pool is None or depth > 1:
+      for (cid, opt), (ruled_out, settled) in zip(trials, known):
+        if ruled_out is None:
+          check_budget()
+          settled = trial(puzzle, cid, opt, depth, max_depth, settled)
+          cache.record(puzzle, cid, opt, levels, start, settled)
+          ruled_out = settled is None
+        yield cid, opt, ruled_out
+      return
+    to_run = [(cid, opt, depth, max_depth, settled)
+      for (cid, opt), (ruled_out, settled) in zip(trials, known) if ruled_out is None]
+    results = pool.map(name, 'trial', puzzle, base_solver.disabled_deducers, to_run)
+    try:
+      for (cid, opt), (ruled_out, _) in zip(trials, known):
+        if ruled_out is None:
+          settled = next(results)
+          cache.record(puzzle, cid, opt, levels, start, settled)
+          ruled_out = settled is None
+        yield cid, opt, ruled_out
+    finally:
+      results.close()
+  def recursive_deduce(puzzle, depth, max_depth, cache):
     if depth > max_depth:
       return None
     opt_counts = [(cid, len(opts)) for cid, opts in puzzle.cell_options.items() if len(opts)>1]
     opt_counts.sort(key = lambda x: x[1])
-    for cid, _ in opt_counts:
-      opts = puzzle.cell_options[cid]
-      for opt in opts:
-        puzzle.cell_options[cid] = [opt]
-        puzzle_state = puzzle.save()   
-        deduction = True
-        while deduction and not puzzle.broken() and puzzle.constraints_satisfied():
-          deduction = base_solver.make_deduction(puzzle) 
-          if not deduction:
-            deduction = recursive_deduce(puzzle, depth+1, max_depth)
-        ruled_out = puzzle.broken() or not puzzle.constraints_satisfied()
-        puzzle.load(puzzle_state)
+    trials = [(cid, opt) for cid, _ in opt_counts for opt in puzzle.cell_options[cid]]
+    results = outcomes(puzzle, trials, depth, max_depth, cache, cache.state(puzzle))
+    try:
+      for cid, opt, ruled_out in results:
         if ruled_out:
-          puzzle.cell_options[cid] = [o for o in opts if o != opt]
-          return Deduction('{} ruled out'.format(opt), [cid])
-      puzzle.cell_options[cid] = opts
+          puzzle.cell_options[cid] = [o for o in puzzle.cell_options[cid] if o != opt]
+          return Deduction('ruled out', [cid], options=opt)
+    finally:
+      results.close()
     return None
   name = 'Bifurcation ({})'.format(max_depth)
   def deducer(puzzle):
+    cache = get_cache(puzzle)
     base_solver.disabled_deducers.append(r'Bifurcation.*')
-    lvl = 1
-    deduction = recursive_deduce(puzzle, 1, max_depth=lvl)
-    while not deduction and lvl < max_depth:
-      lvl += 1
-      print('Raising bifurcation level to {}.'.format(lvl)) 
-      deduction = recursive_deduce(puzzle, 1, max_depth=lvl)
-    base_solver.disabled_deducers.pop(-1)
+    try:
+      lvl = 1
+      deduction = recursive_deduce(puzzle, 1, max_depth=lvl, cache=cache)
+      while not deduction and lvl < max_depth:
+        lvl += 1
+        deduction = recursive_deduce(puzzle, 1, max_depth=lvl, cache=cache)
+    finally:
+      base_solver.disabled_deducers.pop(-1)
     return deduction
+  # run by TrialPool workers
+  deducer.trial = trial
   return name, deducer
 
 def get_constraint_violation_deducer():
-  def deducer(puzzle):
-    for constraint_name, constraint in puzzle.constraints.items():
-      for cid in puzzle.cell_options.keys():
+  def deducer(puzzle, constraints=None):
+    if constraints is None:
+      constraints = puzzle.constraints.items()
+    for constraint_name, constraint in constraints:
+      # constraints with a propagator prune every cell in one go; the rest
+      # are tried an option at a time
+      allowed = constraint.propagate(puzzle)
+      for cid in constraint.cells:
         opts = puzzle.cell_options[cid]
         if len(opts) <= 1:
           continue
-        cell_violations = set()
-        for opt in opts:
-          puzzle.cell_options[cid] = [opt]
-          if not constraint(puzzle) or constraint.broken(puzzle):
-            cell_violations.add(opt)
+        if allowed is None:
+          cell_violations = constraint.options_ruled_out(puzzle, cid, opts)
+        else:
+          cell_violations = set(opts).difference(allowed[cid])
         if len(cell_violations) == len(opts)-1:
           solution = list((set(opts)-cell_violations))[0]
           puzzle.cell_options[cid] = [solution]
-          return Deduction('Naked single, {}'.format(solution), [cid])
+          return Deduction('naked single', [cid], options=solution)
         elif cell_violations:
           puzzle.cell_options[cid] = [o for o in opts if o not in cell_violations]
-          return Deduction('{} ruled out'.format(sorted(list(cell_violations))), [cid])
-        puzzle.cell_options[cid] = opts
+          return Deduction('ruled out', [cid], options=sorted(list(cell_violations)))
     return None
+  deducer.per_constraint = True
   return 'Constraint Violation', deducer
 
 def get_only_opt_deducer():
-  def deducer(puzzle):
+  def deducer(puzzle, constraints=None):
+    if constraints is None:
+      constraints = puzzle.constraints.items()
     oec_constraints = 0
-    for constraint_name, constraint in puzzle.constraints.items():
+    for constraint_name, constraint in constraints:
       if type(constraint) != state.OneEachConstraint:
         continue
       oec_constraints += 1
+      bitset = puzzle.bitset
+      if bitset is not None:
+        # options seen in at least one, and at least two, of the cells
+        masks = bitset.masks
+        ids = constraint.cell_ids(bitset)
+        once = twice = fixed = 0
+        for i in ids:
+          m = masks[i]
+          if m and not m & (m-1):
+            fixed |= m
+          twice |= once & m
+          once |= m
+        single = once & ~twice & ~fixed
+        if single:
+          for opt in constraint.options:
+            bit = bitset.bit(opt)
+            if single & bit:
+              cid = next(cid for cid, i in zip(constraint.cells, ids) if masks[i] & bit)
+              puzzle.cell_options[cid] = [opt]
+              return Deduction('only cell', [cid], options=opt, constraints=constraint_name)
+        continue
       opt_counts = {}
       for opt in constraint.options:
         opt_counts[opt] = 0
@@ -116,88 +842,243 @@ def get_only_opt_deducer():
         if cnt == 1 and opt not in fixed:
           cid = last_seen[opt]
           puzzle.cell_options[cid] = [opt]
-          return Deduction('Only one cell for {} in {}'.format(opt, constraint_name), [cid])
+          return Deduction('only cell', [cid], options=opt, constraints=constraint_name)
     return None
+  deducer.per_constraint = True
   return "Only Option", deducer
 
-def combinations(choices, options, minimum=0):
-  """
-  Returns all ordered of length 'choices' that can be made from range(options)
-  for which all elements are greater than or equal to 'minimum'.
-  """
-  for first_choice in range(minimum, options):
-    if choices == 1:
-      yield [first_choice]
-    else:
-      for sub_combination in combinations(choices-1, options, minimum=first_choice+1):
-        yield [first_choice]+sub_combination
+def _find_tuple(masks, size):
+  # Returns the indexes of 'size' masks whose union has exactly 'size' bits,
+  # or None. Any set whose union already has too many bits is cut off along
+  # with all its supersets.
+  chosen = []
+  def search(start, union):
+    if len(chosen) < 2:
+      check_budget()
+    if len(chosen) == size:
+      return popcount(union) == size
+    for i in range(start, len(masks)-(size-len(chosen))+1):
+      u = union | masks[i]
+      if popcount(u) > size:
+        continue
+      chosen.append(i)
+      if search(i+1, u):
+        return True
+      chosen.pop()
+    return False
+  return chosen if search(0, 0) else None
 
 def get_tuple_deducer():
-  def deducer(puzzle):
-    # TODO: clean up previous tuple deduction data that has become irrelevant
-    for constraint_name, constraint in list(puzzle.constraints.items()):
+  def deducer(puzzle, constraints=None):
+    if constraints is None:
+      constraints = list(puzzle.constraints.items())
+    bitset = puzzle.bitset
+    for constraint_name, constraint in constraints:
       if type(constraint) != state.OneEachConstraint:
         continue
-      # find unlocked cells
-      cell_options = ((cid, puzzle.cell_options[cid]) for cid in constraint.cells)
-      unlocked_cells = filter(lambda x: len(x[1])>1, cell_options)
-      # remove known tuples from unlocked cells
-      if 'tuple_cell_sets' not in puzzle.deductions:
-        puzzle.deductions['tuple_cell_sets'] = dict()
-      tuple_cell_sets = puzzle.deductions['tuple_cell_sets'].get(constraint_name, set())
-      if tuple_cell_sets:
-        unlocked_cells = filter(lambda x: x[0] not in tuple_cell_sets, unlocked_cells)
-      unlocked_cells = list(unlocked_cells)
-      # find tuples
+      # find unlocked cells, leaving out those in tuples already found
+      tuple_cell_sets = puzzle.deductions.get('tuple_cell_sets', {}).get(constraint_name, ())
+      unlocked_cells = [cid for cid in constraint.cells
+        if len(puzzle.cell_options[cid]) > 1 and cid not in tuple_cell_sets]
+      # A naked tuple is k cells with only k options between them, which can
+      # be ruled out of the other cells. A hidden tuple is k options that are
+      # only in k cells, whose other options can be ruled out. Either splits
+      # the unlocked cells in two, and the smaller side is at most half of
+      # them, so only tuples up to that size are searched for.
       # example:
       # [123, 12, 567, 13, 235, 67] -> 0, 1, and 3 are a tuple, rulling out 2 and 3 from 4
-      for tuple_length in range(2, len(unlocked_cells)-1):
-        for combination in combinations(tuple_length, len(unlocked_cells)):
-          tup = [unlocked_cells[i][0] for i in combination]
-          tup_opts = set()
-          for cell in tup:
-            for opt in puzzle.cell_options[cell]:
-              tup_opts.add(opt)
-          if len(tup) != len(tup_opts):
+      max_size = len(unlocked_cells)//2
+      if max_size < 2:
+        continue
+      # options of the constraint's other cells: those locked, which unlocked
+      # cells may still hold until Constraint Violation rules them out, and
+      # those in tuples already found
+      searched = set(unlocked_cells)
+      elsewhere = set(opt for cid in constraint.cells if cid not in searched for opt in puzzle.cell_options[cid])
+      if bitset is not None:
+        cell_masks = [bitset.masks[bitset.index[cid]] for cid in unlocked_cells]
+        bits = [1 << i for i in range(len(bitset.options)) if any(m >> i & 1 for m in cell_masks)]
+        opt_of = {bit: bitset.options[bit.bit_length()-1] for bit in bits}
+      else:
+        opt_list = sorted(set(opt for cid in unlocked_cells for opt in puzzle.cell_options[cid]))
+        opt_bits = {opt: 1 << i for i, opt in enumerate(opt_list)}
+        cell_masks = []
+        for cid in unlocked_cells:
+          m = 0
+          for opt in puzzle.cell_options[cid]:
+            m |= opt_bits[opt]
+          cell_masks.append(m)
+        bits = [opt_bits[opt] for opt in opt_list]
+        opt_of = {bit: opt for opt, bit in opt_bits.items()}
+      # a hidden tuple's options have to go in its cells, which only holds if
+      # the constraint has an option for every cell, and for options no other
+      # cell can take
+      if len(constraint.options) == len(constraint.cells):
+        hidden_bits = [bit for bit in bits if opt_of[bit] not in elsewhere]
+      else:
+        hidden_bits = []
+      # for each option, the unlocked cells it is in, as a mask of positions
+      opt_masks = []
+      for bit in hidden_bits:
+        m = 0
+        for i, cell_mask in enumerate(cell_masks):
+          if cell_mask & bit:
+            m |= 1 << i
+        opt_masks.append(m)
+      for size in range(2, max_size+1):
+        hidden = False
+        chosen = _find_tuple(cell_masks, size)
+        if chosen is None:
+          hidden = True
+          chosen = _find_tuple(opt_masks, size)
+          if chosen is None:
             continue
-          # tuple found
-          # remember to skip cells in this tuple on next pass
-          puzzle.deductions['tuple_cell_sets'][constraint_name] = tuple_cell_sets.union(tup)
-          # add deduced OneEachConstraint to puzzle
-          name = '{} tuple in {}'.format(sorted(list(tup_opts)), constraint_name)
-          puzzle.constraints[name] = state.OneEachConstraint(tup, tup_opts)
-          # remove options in this tuple from the other unlocked cells in this constraint
-          affected = set()
-          tup_set = set(tup)
-          for cid, options in unlocked_cells:
-            if cid in tup_set:
-              continue
-            filtered_options = []
-            for opt in options:
-              if opt in tup_opts:
-                affected.add(cid)
-              else:
-                filtered_options.append(opt)
+          tup_mask = 0
+          for j in chosen:
+            tup_mask |= hidden_bits[j]
+          positions = 0
+          for j in chosen:
+            positions |= opt_masks[j]
+          chosen = [i for i in range(len(unlocked_cells)) if positions >> i & 1]
+        else:
+          tup_mask = 0
+          for i in chosen:
+            tup_mask |= cell_masks[i]
+        tup = [unlocked_cells[i] for i in chosen]
+        tup_opts = [opt_of[bit] for bit in bits if tup_mask & bit]
+        # remember to skip cells in this tuple on later passes, dropping any
+        # bookkeeping for cells since locked or constraints since removed
+        old_sets = puzzle.deductions.get('tuple_cell_sets', {})
+        tuple_sets = {}
+        for name, cells in old_sets.items():
+          if name in puzzle.constraints:
+            cells = frozenset(cid for cid in cells if len(puzzle.cell_options[cid]) > 1)
+            if cells:
+              tuple_sets[name] = cells
+        tuple_sets[constraint_name] = tuple_sets.get(constraint_name, frozenset()).union(tup)
+        puzzle.deductions['tuple_cell_sets'] = tuple_sets
+        # add deduced OneEachConstraint to puzzle
+        name = '{} tuple in {}'.format(tup_opts, constraint_name)
+        puzzle.add_constraint(name, state.OneEachConstraint(tup, tup_opts), derived=True)
+        tup_opt_set = set(tup_opts)
+        affected = []
+        if hidden:
+          # rule out the other options from the cells in the tuple
+          for cid in tup:
+            options = puzzle.cell_options[cid]
+            filtered_options = [opt for opt in options if opt in tup_opt_set]
+            if len(filtered_options) < len(options):
+              affected.append(cid)
+              puzzle.cell_options[cid] = filtered_options
+          return Deduction('hidden tuple', affected, options=tup_opts, constraints=name)
+        # remove options in this tuple from the other unlocked cells in this constraint
+        tup_set = set(tup)
+        for cid in unlocked_cells:
+          if cid in tup_set:
+            continue
+          options = puzzle.cell_options[cid]
+          filtered_options = [opt for opt in options if opt not in tup_opt_set]
+          if len(filtered_options) < len(options):
+            affected.append(cid)
             puzzle.cell_options[cid] = filtered_options
-          return Deduction('Found {}'.format(name), list(affected))
+        return Deduction('tuple', affected, options=tup_opts, constraints=name)
+  deducer.per_constraint = True
   return 'Tuples', deducer
 
+class UniquenessTable:
+  """
+  The uniqueness constraints of a puzzle, in constraint order, with which of
+  them intersect and the cells they share. Pointy-Fish deducers share one
+  table per constraint set; see 'uniqueness_table'.
+  """
+  def __init__(self, puzzle):
+    self.constraints = [(name, con) for name, con in puzzle.constraints.items() if con.implies_uniqueness()]
+    position = {name: i for i, (name, _) in enumerate(self.constraints)}
+    # bit j of neighbours[i] is set if constraints i and j share a cell
+    self.neighbours = []
+    for name, constraint in self.constraints:
+      near = 0
+      for cid in constraint.cells:
+        for other in puzzle.constraints_of(cid):
+          if other in position:
+            near |= 1 << position[other]
+      self.neighbours.append(near)
+    # bit k of cell_masks[i] is set if constraint i holds cells[k], and bit i
+    # of cell_constraints[k] is set likewise
+    self.cells = []
+    index = {}
+    self.cell_masks = []
+    for name, constraint in self.constraints:
+      mask = 0
+      for cid in constraint.cells:
+        if cid not in index:
+          index[cid] = len(self.cells)
+          self.cells.append(cid)
+        mask |= 1 << index[cid]
+      self.cell_masks.append(mask)
+    self.cell_constraints = [0]*len(self.cells)
+    for i, mask in enumerate(self.cell_masks):
+      for k in _bit_indexes(mask):
+        self.cell_constraints[k] |= 1 << i
+    self._intersections = {}
+  def intersection(self, i, j):
+    key = (i, j) if i < j else (j, i)
+    cells = self._intersections.get(key)
+    if cells is None:
+      other = set(self.constraints[key[1]][1].cells)
+      cells = tuple(cid for cid in self.constraints[key[0]][1].cells if cid in other)
+      self._intersections[key] = cells
+    return cells
+
+# puzzle -> {constraint set version: UniquenessTable}, most recent last
+_uniqueness_tables = weakref.WeakKeyDictionary()
+_MAX_UNIQUENESS_TABLES = 8
+# topology -> UniquenessTable of its constraints
+_topology_tables = weakref.WeakKeyDictionary()
+
+def uniqueness_table(puzzle):
+  # Returns the puzzle's UniquenessTable, only rebuilding it when constraints
+  # have been added or removed. Tables for a few recent constraint sets are
+  # kept, since rolling back a trial often returns to one, and puzzles with
+  # just their topology's constraints share its table.
+  tables = _uniqueness_tables.setdefault(puzzle, {})
+  key = puzzle.constraint_set_version()
+  table = tables.pop(key, None)
+  if table is None:
+    if puzzle.shares_constraints():
+      table = _topology_tables.get(puzzle.topology)
+      if table is None:
+        table = _topology_tables[puzzle.topology] = UniquenessTable(puzzle)
+    else:
+      table = UniquenessTable(puzzle)
+    if len(tables) >= _MAX_UNIQUENESS_TABLES:
+      del tables[next(iter(tables))]
+  tables[key] = table
+  return table
+
+def _bit_indexes(mask):
+  # Yields the indexes of the set bits of 'mask', lowest first.
+  while mask:
+    low = mask & -mask
+    yield low.bit_length()-1
+    mask ^= low
+
 def get_pointy_fish_deducer(min_size, max_size):
   # TODO: figure out how to incorperate non-unique constraints that constraint an option (n times) to a region that overlaps uniqueness constraints.
-  def intersects(constraint_a, constraint_b):
-    sa = set(constraint_a[1].cells)
-    return any(cb in sa for cb in constraint_b[1].cells)
-  def pointy_fish_set_iter(uniqueness_constraints, min_length, max_length, base_a = None, base_b = None):
+  def pointy_fish_set_iter(neighbours, min_length, max_length, base_a = None, base_b = None, masks = None, prune = None, alive = None):
     """
     Returns all combinations of sets of constraints, (a,b) such that each element of 'a'
     does not intersect with any other element of 'a', each element of 'b' does not intersect
     with any other element of 'b', each element of 'a' intersects all elements of 'b', and
     each element of 'b' intersects all elements of 'a'.
-    'uniqueness_constraints' is a list of tuples of the form (constraint_name, constraint)
+    'neighbours' is the intersection bitmask of each constraint, see UniquenessTable
     'min_length' is the minimum length of 'a' and 'b' which are returned
     'max_length' is the maximum length of 'a' and 'b' which are returned
     'a' and 'b' are lists of integer indexes
-    'base_a' and 'base_b' are used internally for recursion
+    'prune', if given, is called as prune(a, b, masks, alive) each time 'a' or 'b'
+    is extended, and returns None to skip the pair and every extension of it,
+    or the 'alive' state to pass on to its extensions
+    'base_a', 'base_b', 'masks' and 'alive' are used internally for recursion
     """
     a = [] if base_a is None else base_a
     b = [] if base_b is None else base_b
@@ -205,46 +1086,126 @@ def get_pointy_fish_deducer(min_size, max_size):
       yield a,b
     if len(a) == max_length and len(b) == max_length:
       return
+    # constraints intersecting all of 'a', any of 'a', all of 'b' and any of 'b'
+    everything = (1 << len(neighbours))-1
+    a_all, a_any, b_all, b_any = (everything, 0, everything, 0) if masks is None else masks
+    b_set = 0
+    for bi in b:
+      b_set |= 1 << bi
     # add all distinct constraint to 'a' that intersects all of 'b' and iterate on the resulting possibilities
     # avoid double counting combinations of a [1,3] and [3,1] for example
     min_new_a = 0 if not a else a[-1]+1 
-    for i in range(min_new_a, len(uniqueness_constraints)):
-      if i in b:
-        continue
-      if any(intersects(uniqueness_constraints[i], uniqueness_constraints[ai]) for ai in a):
-        continue
-      if any(not intersects(uniqueness_constraints[i], uniqueness_constraints[bi]) for bi in b):
-        continue
+    for i in _bit_indexes(b_all & ~a_any & ~b_set & (everything >> min_new_a << min_new_a)):
       new_a = a+[i]
-      min_new_b = new_a[0]+1 if not b else b[-1]+1
-      for j in range(min_new_b, len(uniqueness_constraints)):
-        if any(not intersects(uniqueness_constraints[j], uniqueness_constraints[ai]) for ai in new_a):
-          continue
-        if any(intersects(uniqueness_constraints[j], uniqueness_constraints[bi]) for bi in b):
+      new_a_all, new_a_any = a_all & neighbours[i], a_any | neighbours[i]
+      a_alive = None
+      if prune is not None:
+        a_alive = prune(new_a, b, (new_a_all, new_a_any, b_all, b_any), alive)
+        if a_alive is None:
           continue
+      min_new_b = new_a[0]+1 if not b else b[-1]+1
+      for j in _bit_indexes(new_a_all & ~b_any & (everything >> min_new_b << min_new_b)):
         new_b = b+[j]
-        for result in pointy_fish_set_iter(uniqueness_constraints, min_length, max_length, base_a = new_a, base_b = new_b):
+        new_masks = (new_a_all, new_a_any, b_all & neighbours[j], b_any | neighbours[j])
+        new_alive = None
+        if prune is not None:
+          new_alive = prune(new_a, new_b, new_masks, a_alive)
+          if new_alive is None:
+            continue
+        for result in pointy_fish_set_iter(neighbours, min_length, max_length, base_a = new_a, base_b = new_b, masks = new_masks, prune = prune, alive = new_alive):
           yield result
       
   def deducer(puzzle):
     DEBUG = False
-    uniqueness_constraints = [(name, con) for name, con in puzzle.constraints.items() if con.implies_uniqueness()]
-    for a, b in pointy_fish_set_iter(uniqueness_constraints, min_size, max_size):
+    table = uniqueness_table(puzzle)
+    uniqueness_constraints = table.constraints
+    # cell options and free cells of each constraint, read once per call
+    cell_options = {}
+    free_cells = [None]*len(uniqueness_constraints)
+    def free(i):
+      if free_cells[i] is None:
+        cells = []
+        for cid in uniqueness_constraints[i][1].cells:
+          if cid not in cell_options:
+            cell_options[cid] = puzzle.cell_options[cid]
+          if len(cell_options[cid]) > 1:
+            cells.append(cid)
+        free_cells[i] = cells
+      return free_cells[i]
+    # A pair can only rule 'opt' out of b-only cells once every free cell of
+    # 'a' with 'opt' is also in 'b', and each constraint of 'a' has 'opt' in a
+    # cell it shares with 'b' (and vice versa), so pairs are skipped with their
+    # extensions once neither holds for any option in any extension.
+    # Bit k of free_option_cells[opt] is set if table.cells[k] is free with
+    # 'opt', and of option_cells[opt] if it has 'opt' at all.
+    free_option_cells, option_cells = {}, {}
+    for k, cid in enumerate(table.cells):
+      opts = puzzle.cell_options[cid]
+      for opt in opts:
+        option_cells[opt] = option_cells.get(opt, 0) | (1 << k)
+        if len(opts) > 1:
+          free_option_cells[opt] = free_option_cells.get(opt, 0) | (1 << k)
+    everything = (1 << len(uniqueness_constraints))-1
+    def coverable(opt, members, other_cells, candidates, count):
+      # False if the cells 'members' need in 'other_cells' for 'opt' can't be
+      # covered by 'count' more of the 'candidates' constraints.
+      free, held = free_option_cells[opt], option_cells[opt]
+      cells = 0
+      for i in members:
+        mask = table.cell_masks[i]
+        if free & mask:
+          cells |= free & mask & ~other_cells
+        elif not held & mask:
+          return False
+        elif not held & mask & other_cells and not held & mask & (held & mask)-1:
+          cells |= held & mask
+      # cells sharing none of the candidates each need their own
+      used = 0
+      while cells:
+        low = cells & -cells
+        cells ^= low
+        options = table.cell_constraints[low.bit_length()-1] & candidates
+        if not options & used:
+          if not options or count == 0:
+            return False
+          count -= 1
+          used |= options
+      return True
+    def prune(a, b, masks, alive):
+      check_budget()
+      a_all, a_any, b_all, b_any = masks
+      a_cells = b_cells = b_set = 0
+      for i in a:
+        a_cells |= table.cell_masks[i]
+      for j in b:
+        b_cells |= table.cell_masks[j]
+        b_set |= 1 << j
+      # constraints that could still be added to 'a' and 'b'
+      min_a, min_b = a[-1]+1, b[-1]+1 if b else a[0]+1
+      more_a = b_all & ~a_any & ~b_set & (everything >> min_a << min_a)
+      more_b = a_all & ~b_any & (everything >> min_b << min_b)
+      alive_a, alive_b = alive or (free_option_cells, free_option_cells)
+      alive_a = [opt for opt in alive_a if coverable(opt, a, b_cells, more_b, max_size-len(b))]
+      alive_b = [opt for opt in alive_b if coverable(opt, b, a_cells, more_a, max_size-len(a))]
+      if not alive_a and not alive_b:
+        return None
+      return alive_a, alive_b
+    for a, b in pointy_fish_set_iter(table.neighbours, min_size, max_size, prune = prune):
       a_names = [uniqueness_constraints[i][0] for i in a]
       b_names = [uniqueness_constraints[i][0] for i in b]
       # find all free cells
       a_cells, b_cells = [], []
       for i in a:
-        a_cells.extend(cid for cid in uniqueness_constraints[i][1].cells if len(puzzle.cell_options[cid])>1)
+        a_cells.extend(free(i))
       for i in b:
-        b_cells.extend(cid for cid in uniqueness_constraints[i][1].cells if len(puzzle.cell_options[cid])>1)
+        b_cells.extend(free(i))
       a_cells, b_cells = set(a_cells), set(b_cells)
       if not a_cells or not b_cells:
         continue
       # find their intersection and differences
       ab_opts, ao_opts, bo_opts = set(), set(), set()
       for cid in (a_cells | b_cells):
-        opts = puzzle.cell_options[cid]
+        opts = cell_options[cid]
         in_a = cid in a_cells
         in_b = cid in b_cells
         if in_a and in_b:
@@ -267,8 +1228,7 @@ def get_pointy_fish_deducer(min_size, max_size):
         for i in a:
           int_opts = set()
           for j in b:
-            intersection = set(uniqueness_constraints[i][1].cells) & set(uniqueness_constraints[j][1].cells)
-            for cid in intersection:
+            for cid in table.intersection(i, j):
               int_opts.update(puzzle.cell_options[cid])
           constrained_a_opts &= int_opts
           if not constrained_a_opts:
@@ -282,7 +1242,7 @@ def get_pointy_fish_deducer(min_size, max_size):
           final_len = len(puzzle.cell_options[cid])
           if final_len != init_len:
             found.append(cid)
-        ret = Deduction("(a) Ruled out {} from cells in {} but not {}".format(ruled_out_b_opts, b_names, a_names), found)
+        ret = Deduction('fish', found, side='a', options=ruled_out_b_opts, constraints=b_names, excluding=a_names)
         if DEBUG:
           print('a: {}'.format(a_names))
           print('ab_opts: {}'.format(ab_opts)) 
@@ -304,8 +1264,7 @@ def get_pointy_fish_deducer(min_size, max_size):
         for j in b:
           int_opts = set()
           for i in a:
-            intersection = set(uniqueness_constraints[i][1].cells) & set(uniqueness_constraints[j][1].cells)
-            for cid in intersection:
+            for cid in table.intersection(i, j):
               int_opts.update(puzzle.cell_options[cid])
           constrained_b_opts &= int_opts
           if not constrained_b_opts:
@@ -319,7 +1278,7 @@ def get_pointy_fish_deducer(min_size, max_size):
           final_len = len(puzzle.cell_options[cid])
           if final_len != init_len:
             found.append(cid)
-        ret = Deduction("(b) Ruled out {} from cells in {} but not {}".format(ruled_out_a_opts, a_names, b_names), found)
+        ret = Deduction('fish', found, side='b', options=ruled_out_a_opts, constraints=a_names, excluding=b_names)
         if DEBUG:
           print('a: {}'.format(a_names))
           print('ab_opts: {}'.format(ab_opts)) 
@@ -335,87 +1294,185 @@ def get_pointy_fish_deducer(min_size, max_size):
         return ret
   return "Pointy-Fish", deducer
 
-def get_odd_wing_deducer(base_solver, max_depth=5, max_split=2):
-  def deduce(puzzle, solver, max_depth):
+def get_odd_wing_deducer(base_solver, max_depth=5, max_split=2, pool=None):
+  name = 'Odd Wing ({}, {})'.format(max_depth, max_split)
+  # The chain of deductions that follows from locking a cell to an option is
+  # kept for the rest of the call in a cache, (cid, opt) -> (trail, ended), so
+  # it is run once for every depth. 'trail' holds the options of the cells
+  # affected so far after each step, and 'ended' is set if the chain stopped
+  # before running out of steps.
+  def follow(puzzle, cid, opt, depth):
+    # Returns (trail, ended) for the chain from locking 'cid' to 'opt', run
+    # for up to 'depth' steps.
+    puzzle.checkpoint()
+    try:
+      puzzle.cell_options[cid] = [opt]
+      cells_affected = set()
+      trail = []
+      deduction = True
+      while True:
+        if not deduction or not puzzle.constraints_satisfied() or puzzle.broken():
+          return trail, True
+        if len(trail) >= depth:
+          return trail, False
+        deduction = base_solver.make_deduction(puzzle)
+        if deduction:
+          cells_affected.update(deduction[1].cells_affected)
+        trail.append({c: frozenset(puzzle.cell_options[c]) for c in cells_affected})
+    finally:
+      puzzle.rollback()
+  def chain(puzzle, cid, opt, depth, cache, pending):
+    # Returns (steps, {cid: options}) for the chain from locking 'cid' to
+    # 'opt', cut off at 'depth' steps. Chains sent to the pool are in
+    # 'pending', as (deque of (cid, opt), generator of results).
+    if pending is not None and (cid, opt) in pending[0]:
+      keys, results = pending
+      while True:
+        key = keys.popleft()
+        entry = cache[key] = next(results)
+        if key == (cid, opt):
+          break
+    else:
+      entry = cache.get((cid, opt))
+      if entry is None:
+        entry = cache[(cid, opt)] = follow(puzzle, cid, opt, depth)
+      elif len(entry[0]) < depth and not entry[1]:
+        # a chain is only rerun once it's needed deeper, and then it's run
+        # all the way so later depths come from the cache
+        entry = cache[(cid, opt)] = follow(puzzle, cid, opt, max_depth)
+    trail = entry[0]
+    steps = min(depth, len(trail))
+    return steps, (trail[steps-1] if steps else {})
+  def send(puzzle, depth, cache):
+    # Sends the chains the next pass needs that aren't cached to the pool,
+    # run all the way so later depths come from the cache.
+    keys = collections.deque()
+    for cid, opts in puzzle.cell_options.items():
+      if len(opts) <= max_split:
+        for opt in opts:
+          entry = cache.get((cid, opt))
+          if entry is None or (len(entry[0]) < depth and not entry[1]):
+            keys.append((cid, opt))
+    results = pool.map(name, 'follow', puzzle, base_solver.disabled_deducers,
+      [(cid, opt, max_depth) for cid, opt in keys])
+    return keys, results
+  def deduce(puzzle, depth, cache, pending):
+    # the puzzle is only found to be broken in a chain's starting state
+    ruled_out = not puzzle.constraints_satisfied() or puzzle.broken()
     for cur_cid in puzzle.cell_options.keys():
       opts = puzzle.cell_options[cur_cid]
       if len(opts) > max_split:
         continue
+      check_budget()
       # cid in here if cid affected in every opt choice
       joint_cells_affected = None
       # values are sets of the union of options at the end of deduction chains
       joint_cell_options = None
       for opt in opts:
-        puzzle_state = puzzle.save()   
-        puzzle.cell_options[cur_cid] = [opt]
-        cells_affected = set()
-        steps = 0
-        deduction = True
-        while steps < max_depth and deduction and puzzle.constraints_satisfied() and not puzzle.broken():
-          deduction = solver.make_deduction(puzzle)
-          if deduction:
-            cells_affected.update(deduction[1].cells_affected)
-          steps+=1
-        cell_options = {}
-        for cid in cells_affected:
-          cell_options[cid] = set(puzzle.cell_options[cid])
-        puzzle.load(puzzle_state)
-        if not puzzle.constraints_satisfied() or puzzle.broken():
+        steps, chain_options = chain(puzzle, cur_cid, opt, depth, cache, pending)
+        if ruled_out:
           puzzle.cell_options[cur_cid] = [o for o in opts if o != opt]
-          return Deduction('Chain of length {} ruled out {}'.format(steps, opt), [cur_cid])
+          return Deduction('chain', [cur_cid], length=steps, options=opt)
+        cells_affected = set(chain_options)
         if joint_cells_affected is not None:
           for cid in (joint_cells_affected-cells_affected):
             del joint_cell_options[cid]
           joint_cells_affected = joint_cells_affected & cells_affected
           for cid in joint_cells_affected:
-            joint_cell_options[cid] = joint_cell_options[cid] | cell_options[cid]
+            joint_cell_options[cid] = joint_cell_options[cid] | chain_options[cid]
         else:
           joint_cells_affected = cells_affected
-          joint_cell_options = cell_options
+          joint_cell_options = dict(chain_options)
         if not joint_cells_affected:
           break
       if joint_cells_affected:
         real_affected = []
-        ruled_out = []
+        ruled_out_opts = []
         for cid in joint_cells_affected:
-          if len(joint_cell_options[cid]) < len(puzzle.cell_options[cid]):
+          old = set(puzzle.cell_options[cid])
+          new_opts = joint_cell_options[cid] & old
+          if len(new_opts) < len(old):
             real_affected.append(cid)
-            old = set(puzzle.cell_options[cid])
-            puzzle.cell_options[cid] = sorted(list(joint_cell_options[cid]))
-            ruled_out.append(old-joint_cell_options[cid])
+            puzzle.cell_options[cid] = sorted(list(new_opts))
+            ruled_out_opts.append(old-new_opts)
         if real_affected:
-          return Deduction('For every option ({}) in {}, ruled out {} from cells respectively.'.format(puzzle.cell_options[cur_cid], cur_cid, ruled_out), real_affected)
-  name = 'Odd Wing ({}, {})'.format(max_depth, max_split)
+          return Deduction('odd wing', real_affected, options=puzzle.cell_options[cur_cid], cells=cur_cid, ruled_out=ruled_out_opts)
   def deducer(puzzle):
     base_solver.disabled_deducers.append(r'Bifurcation.*')
     base_solver.disabled_deducers.append(r'Odd Wing.*')
+    # chains only hold for the puzzle as it is, so they are kept for this
+    # call's depths and no longer
+    cache = {}
     deduction = None
-    # TODO: it would be more efficient to deduce at max depth and backtrack to minimum depth needed for the deduced cell.
-    depth = 0 
-    while depth < max_depth and deduction is None:
-      depth += 1
-      deduction = deduce(puzzle, base_solver, depth)
-    base_solver.disabled_deducers.pop(-1)
-    base_solver.disabled_deducers.pop(-1)
+    try:
+      depth = 0
+      while depth < max_depth and deduction is None:
+        depth += 1
+        if pool is None:
+          deduction = deduce(puzzle, depth, cache, None)
+          continue
+        pending = send(puzzle, depth, cache)
+        try:
+          deduction = deduce(puzzle, depth, cache, pending)
+        finally:
+          pending[1].close()
+    finally:
+      base_solver.disabled_deducers.pop(-1)
+      base_solver.disabled_deducers.pop(-1)
     return deduction
+  # run by TrialPool workers
+  deducer.follow = follow
   return name, deducer
 
+# Difficulty tiers, in order, named after the hardest SudokuSolver deducer a
+# puzzle needs, and the tier of each deducer, by name.
+TIERS = ['singles', 'tuples', 'fish', 'odd_wing', 'bifurcation']
+DEDUCER_TIERS = [
+  (r'Only Option|Constraint Violation', 'singles'),
+  (r'Tuples', 'tuples'),
+  (r'Pointy-Fish', 'fish'),
+  (r'Odd Wing', 'odd_wing'),
+  (r'Bifurcation', 'bifurcation'),
+]
+
+def tier_of(deducer_name):
+  for pattern, tier in DEDUCER_TIERS:
+    if re.match(pattern, deducer_name):
+      return tier
+  return None
+
 class SudokuSolver(Solver):
-  def __init__(self, bifurcation_level=0):
-    super().__init__()
+  def __init__(self, bifurcation_level=0, propagate=True, schedule=None, workers=None):
+    """
+    With 'workers' other than None or 1, the Odd Wing and Bifurcation trials
+    are run in a TrialPool of that many processes (0 for all cores). The same
+    deductions are made as without, only sooner. Call 'close' to stop the
+    workers.
+    """
+    super().__init__(propagate=propagate, schedule=schedule)
+    self.trial_pool = None
+    if workers is not None and workers != 1:
+      factory = partial(SudokuSolver, bifurcation_level=bifurcation_level, propagate=propagate)
+      self.trial_pool = TrialPool(factory, workers or None)
     self.deducers.append(get_only_opt_deducer())
     self.deducers.append(get_constraint_violation_deducer())
+    # the deducers below assume options of locked cells are already ruled out
+    # of their peers, so these always run first
+    self.pinned_deducers = 2
     self.deducers.append(get_tuple_deducer())
     # pointing pairs and x-wings
     for i in range(1,3):
       self.deducers.append(get_pointy_fish_deducer(i, i))
     # Y-wing, skyscraper, winged x-wings, etc.
-    self.deducers.append(get_odd_wing_deducer(self))
+    self.deducers.append(get_odd_wing_deducer(self, pool=self.trial_pool))
     # swordfish and jellyfish
     for i in range(3,5):
       self.deducers.append(get_pointy_fish_deducer(i, i))
     if bifurcation_level != 0:
-      self.deducers.append(get_bifurcation_deducer(self, bifurcation_level))
+      self.deducers.append(get_bifurcation_deducer(self, bifurcation_level, pool=self.trial_pool))
+  def close(self):
+    if self.trial_pool is not None:
+      self.trial_pool.close()
 
 if __name__ == '__main__':
   puzzle = state.Sudoku()
@@ -1,45 +1,566 @@
+from collections.abc import MutableMapping
 from functools import partial
+import copy
+import itertools
+import os
 import pickle
+import tempfile
+
+try:
+  popcount = int.bit_count
+except AttributeError:
+  def popcount(mask):
+    return bin(mask).count('1')
+
+_MISSING = object()
+# Source of change stamps. Stamps only ever increase, so a stamp seen once is
+# never handed out again for a different state.
+_clock = itertools.count(1)
+
+class CellOptions(dict):
+  """
+  The list mode cell -> options dict. Every write that changes a cell gives it
+  a fresh stamp in '_stamps', and '_epoch' holds the latest stamp. While a
+  checkpoint is active, the previous options and stamp are also recorded on
+  '_trail' so the write can be undone.
+  """
+  _trail = None
+  _epoch = 0
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._stamps = {}
+  def __setitem__(self, cid, opts):
+    old = dict.get(self, cid, _MISSING)
+    if old is not opts and old == opts:
+      return
+    if self._trail is not None:
+      self._trail.append((cid, old, self._stamps.get(cid, 0), self._epoch))
+    self._epoch = self._stamps[cid] = next(_clock)
+    dict.__setitem__(self, cid, opts)
+  def _restore(self, cid, old, stamp, epoch):
+    if old is _MISSING:
+      dict.__delitem__(self, cid)
+    else:
+      dict.__setitem__(self, cid, old)
+    self._stamps[cid] = stamp
+    self._epoch = epoch
+  def _swap(self, cid, opts):
+    # Replaces a cell's options without recording a change, returning the old
+    # options. Only for probes that swap the old options straight back.
+    old = dict.__getitem__(self, cid)
+    dict.__setitem__(self, cid, opts)
+    return old
+  def last_change(self, cells):
+    stamps = self._stamps
+    return max((stamps.get(cid, 0) for cid in cells), default=0)
+  def __reduce__(self):
+    # rebuilt from a plain dict, as unpickling a dict subclass would otherwise
+    # set its items before '_stamps' exists
+    return (CellOptions, (dict(self),))
+
+class BitsetCellOptions(MutableMapping):
+  """
+  Compact storage for cell options. Each cell is given a dense integer id and
+  its candidates are held as an integer bitmask in 'masks', indexed by that id.
+  Bit i of a mask is set if 'options[i]' is still a candidate for the cell.
+  The mapping interface (cell -> list of options) is kept for compatibility;
+  reads decode the mask and writes encode the given options.
+  """
+  # decoded option tuples are cached per mask, up to this many distinct masks
+  _MAX_DECODE_CACHE = 1 << 16
+  # (cell id, previous mask, previous stamp, previous epoch) entries, recorded
+  # while a checkpoint is active
+  _trail = None
+  _epoch = 0
+  def __init__(self, cell_options):
+    self._cells = list(cell_options.keys())
+    self._index = {cid: i for i, cid in enumerate(self._cells)}
+    options = []
+    seen = set()
+    for opts in cell_options.values():
+      for opt in opts:
+        if opt not in seen:
+          seen.add(opt)
+          options.append(opt)
+    try:
+      options.sort()
+    except TypeError:
+      pass
+    self._options = options
+    self._bits = {opt: 1 << i for i, opt in enumerate(options)}
+    self._decoded = {}
+    self.masks = [self.encode(opts) for opts in cell_options.values()]
+    self._stamps = [0]*len(self.masks)
+  @ property
+  def cells(self):
+    return self._cells
+  @ property
+  def index(self):
+    # cell -> dense cell id
+    return self._index
+  @ property
+  def options(self):
+    return self._options
+  def bit(self, opt):
+    return self._bits[opt]
+  def encode(self, opts):
+    mask = 0
+    for opt in opts:
+      mask |= self._bits[opt]
+    return mask
+  def decode(self, mask):
+    opts = self._decoded.get(mask)
+    if opts is None:
+      opts = tuple(opt for opt, bit in self._bits.items() if mask & bit)
+      if len(self._decoded) < self._MAX_DECODE_CACHE:
+        self._decoded[mask] = opts
+    return list(opts)
+  def mask(self, cid):
+    return self.masks[self._index[cid]]
+  def ids(self, cells):
+    index = self._index
+    return tuple(index[cid] for cid in cells)
+  def __getitem__(self, cid):
+    return self.decode(self.masks[self._index[cid]])
+  def __setitem__(self, cid, opts):
+    try:
+      i = self._index[cid]
+    except KeyError:
+      raise KeyError('cannot add cell {} to a compact state'.format(cid))
+    mask = self.encode(opts)
+    if mask == self.masks[i]:
+      return
+    if self._trail is not None:
+      self._trail.append((i, self.masks[i], self._stamps[i], self._epoch))
+    self._epoch = self._stamps[i] = next(_clock)
+    self.masks[i] = mask
+  def __delitem__(self, cid):
+    raise TypeError('cannot remove cells from a compact state')
+  def __iter__(self):
+    return iter(self._cells)
+  def __len__(self):
+    return len(self._cells)
+  def __contains__(self, cid):
+    return cid in self._index
+  def _restore(self, i, old, stamp, epoch):
+    self.masks[i] = old
+    self._stamps[i] = stamp
+    self._epoch = epoch
+  def _swap(self, cid, opts):
+    # See CellOptions._swap.
+    i = self._index[cid]
+    old = self.decode(self.masks[i])
+    self.masks[i] = self.encode(opts)
+    return old
+  def copy(self, masks=None):
+    # A BitsetCellOptions sharing this one's cells and options, and so the
+    # cell ids constraints cache for it, with its own copy of 'masks' (or of
+    # this one's) and no stamps or checkpoints.
+    other = BitsetCellOptions.__new__(BitsetCellOptions)
+    other._cells = self._cells
+    other._index = self._index
+    other._options = self._options
+    other._bits = self._bits
+    other._decoded = self._decoded
+    other.masks = list(self.masks if masks is None else masks)
+    other._stamps = [0]*len(other.masks)
+    return other
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_decoded'] = {}
+    state['_stamps'] = [0]*len(self.masks)
+    state.pop('_trail', None)
+    state.pop('_epoch', None)
+    return state
+
+class Topology:
+  """
+  The fixed part of a puzzle: its cells with their initial options, its
+  constraints, the names of the constraints each cell is in and each cell's
+  peers. A Topology is built once and shared read-only by any number of
+  PuzzleStates made from it, which only hold their own cell options and the
+  constraints added to or removed from it since.
+
+  Topologies given a 'source', a (function, args) pair that returns the same
+  topology, pickle as a call to it, so puzzles made from, say,
+  'Sudoku.shared_topology(3)' pickle without their constraints. 'save' and 'load'
+  keep the whole topology on disk instead.
+  """
+  def __init__(self, cell_options, constraints, source=None):
+    self.options = {cid: tuple(opts) for cid, opts in cell_options.items()}
+    self.cells = tuple(self.options)
+    self.constraints = dict(constraints)
+    self.cell_constraints = {}
+    for name, constraint in self.constraints.items():
+      for cid in constraint.cells:
+        self.cell_constraints.setdefault(cid, []).append(name)
+    self.peers = {}
+    for cid, names in self.cell_constraints.items():
+      peers = set()
+      for name in names:
+        peers.update(self.constraints[name].cells)
+      peers.discard(cid)
+      self.peers[cid] = frozenset(peers)
+    self._source = source
+    self._bitset = None
+  def bitset(self, masks=None):
+    # A BitsetCellOptions of the topology's cells holding 'masks' (or the
+    # initial options). All of them share one layout, so constraints only
+    # work out their cell ids once.
+    if self._bitset is None:
+      self._bitset = BitsetCellOptions(self.options)
+    return self._bitset.copy(masks)
+  def shares_layout(self, bitset):
+    return self._bitset is not None and bitset.index is self._bitset.index
+  def __reduce__(self):
+    if self._source is not None:
+      return self._source
+    return (Topology, (self.options, self.constraints))
+  def save(self, path):
+    # Writes the topology to 'path', replacing any file there in one step.
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+      pickle.dump((self.options, self.constraints), f)
+    os.replace(f.name, path)
+  @classmethod
+  def load(cls, path, source=None):
+    with open(path, 'rb') as f:
+      options, constraints = pickle.load(f)
+    return cls(options, constraints, source=source)
 
 class PuzzleState:
-  def __init__(self):
-    self._cell_options = {}
-    self._constraints = {}
+  def __init__(self, topology=None):
+    """
+    An empty puzzle, or with a 'topology', a puzzle with its cells, options
+    and constraints. The topology's constraints and indexes are shared until
+    constraints are added or removed.
+    """
+    self._topology = topology
     self._deductions = {}
+    self._checkpoints = []
+    # names of the constraints deducers have added, in order, see
+    # 'retire_constraints'
+    self._derived = {}
+    if topology is None:
+      self._cell_options = CellOptions()
+      self._constraints = {}
+      # cell -> names of the constraints containing it, built on first use
+      self._cell_constraints = None
+      self._peers = {}
+    else:
+      self._cell_options = CellOptions((cid, list(opts)) for cid, opts in topology.options.items())
+      self._constraints = dict(topology.constraints)
+      self._cell_constraints = topology.cell_constraints
+      self._peers = topology.peers
+    # stamp of the last change not tied to a single cell (constraints added or
+    # removed, state loaded or compacted)
+    self._stamp = next(_clock)
+  @ property
+  def topology(self):
+    return self._topology
   @ property
   def cell_options(self):
     return self._cell_options
   @ property
+  def bitset(self):
+    # The BitsetCellOptions backing a compact state, or None in list mode.
+    if isinstance(self._cell_options, BitsetCellOptions):
+      return self._cell_options
+    return None
+  def compact(self):
+    """
+    Switches to compact mode, storing each cell's options as a bitmask.
+    All cells and options must already be present; 'cell_options' remains
+    usable as a view over the masks.
+    """
+    if self.bitset is None:
+      topology = self._topology
+      if topology is not None and tuple(self._cell_options) == topology.cells:
+        try:
+          bitset = topology.bitset()
+          self._cell_options = bitset.copy([bitset.encode(opts) for opts in self._cell_options.values()])
+        except KeyError:
+          # options the topology doesn't have
+          self._cell_options = BitsetCellOptions(self._cell_options)
+      else:
+        self._cell_options = BitsetCellOptions(self._cell_options)
+      self._stamp = next(_clock)
+    return self
+  @ property
   def constraints(self):
     return self._constraints
   @ property
   def deductions(self):
     return self._deductions
+  def add_constraint(self, name, constraint, derived=False):
+    # Adds (or replaces) a constraint. 'derived' marks one a deducer found,
+    # which 'retire_constraints' removes once it adds nothing.
+    old = self._constraints.get(name)
+    self._constraints[name] = constraint
+    if derived:
+      self._derived[name] = None
+    else:
+      self._derived.pop(name, None)
+    if self._cell_constraints is not None:
+      if old is not None:
+        self._unindex(name, old)
+      self._index(name, constraint)
+    self._stamp = next(_clock)
+  def shares_constraints(self):
+    # True while the constraints are the topology's, in the same order.
+    topology = self._topology
+    if topology is None or len(self._constraints) != len(topology.constraints):
+      return False
+    shared = topology.constraints
+    return all(name == shared_name and constraint is shared[name]
+      for (name, constraint), shared_name in zip(self._constraints.items(), shared))
+  def constraint_set_version(self):
+    # Like 'version', but only changes when constraints are added or removed
+    # (or the state is loaded or compacted).
+    return self._stamp
+  def remove_constraint(self, name):
+    constraint = self._constraints.pop(name)
+    self._derived.pop(name, None)
+    if self._cell_constraints is not None:
+      self._unindex(name, constraint)
+    self._stamp = next(_clock)
+    return constraint
+  @ property
+  def derived_constraints(self):
+    # Names of the derived constraints, in the order they were added.
+    return list(self._derived)
+  def retire_constraints(self):
+    """
+    Removes the derived constraints that no longer add anything: those whose
+    cells are all solved (and which hold), and those on the same cells and
+    options as a constraint that isn't derived or was derived earlier.
+    Returns their names.
+    """
+    if not self._derived:
+      return []
+    bitset = self.bitset
+    # derived constraint -> position, to keep the first of any duplicates
+    order = {name: i for i, name in enumerate(self._derived)}
+    retired = []
+    for name in order:
+      constraint = self._constraints[name]
+      if bitset is not None:
+        masks = bitset.masks
+        solved = all(masks[i] and not masks[i] & (masks[i]-1) for i in constraint.cell_ids(bitset))
+      else:
+        solved = all(len(self._cell_options[cid]) == 1 for cid in constraint.cells)
+      if (solved and constraint(self)) or self._duplicate(name, constraint, order):
+        self.remove_constraint(name)
+        retired.append(name)
+    return retired
+  def _duplicate(self, name, constraint, order):
+    # True if a constraint on the same cells and options stays when 'name' is
+    # retired: one that isn't derived, or was derived earlier.
+    cells = set(constraint.cells)
+    options = set(getattr(constraint, 'options', ()))
+    for other_name in self.constraints_of(constraint.cells[0]):
+      other = self._constraints[other_name]
+      if other_name == name or type(other) is not type(constraint) or order.get(other_name, -1) > order[name]:
+        continue
+      if set(other.cells) == cells and set(getattr(other, 'options', ())) == options:
+        return True
+    return False
+  def _unshare_index(self):
+    # Copies the topology's index before changing it.
+    topology = self._topology
+    if topology is not None and self._cell_constraints is topology.cell_constraints:
+      self._cell_constraints = {cid: list(names) for cid, names in topology.cell_constraints.items()}
+      self._peers = dict(topology.peers)
+  def _index(self, name, constraint):
+    self._unshare_index()
+    for cid in constraint.cells:
+      self._cell_constraints.setdefault(cid, []).append(name)
+      self._peers.pop(cid, None)
+  def _unindex(self, name, constraint):
+    self._unshare_index()
+    for cid in constraint.cells:
+      self._cell_constraints[cid].remove(name)
+      self._peers.pop(cid, None)
+  def constraints_of(self, cid):
+    # Names of the constraints containing cell 'cid'. Constraints should be
+    # added and removed with 'add_constraint' and 'remove_constraint' so this
+    # stays up to date.
+    if self._cell_constraints is None:
+      self._cell_constraints = {}
+      self._peers = {}
+      for name, constraint in self._constraints.items():
+        self._index(name, constraint)
+    return self._cell_constraints.get(cid, ())
+  def peers(self, cid):
+    # Cells sharing at least one constraint with cell 'cid'.
+    peers = self._peers.get(cid)
+    if peers is None:
+      peers = set()
+      for name in self.constraints_of(cid):
+        peers.update(self._constraints[name].cells)
+      peers.discard(cid)
+      peers = self._peers[cid] = frozenset(peers)
+    return peers
+  def version(self, constraint=None):
+    """
+    Returns a value that is unchanged for as long as the puzzle is, or with a
+    'constraint', for as long as that constraint's cells and the set of
+    constraints are. A value is never reused for a different state, although
+    rolling back to a checkpoint restores the value it had there.
+    """
+    if constraint is None:
+      return (self._cell_options._epoch, self._stamp)
+    bitset = self.bitset
+    if bitset is not None:
+      stamps = bitset._stamps
+      return (max(map(stamps.__getitem__, constraint.cell_ids(bitset))), self._stamp)
+    return (self._cell_options.last_change(constraint.cells), self._stamp)
+  def cells_version(self, cells):
+    # Like 'version', but only for the options of 'cells': it is unchanged for
+    # as long as they are, whatever happens to other cells and constraints.
+    bitset = self.bitset
+    if bitset is not None:
+      stamps = bitset._stamps
+      return max(map(stamps.__getitem__, bitset.ids(cells)), default=0)
+    return self._cell_options.last_change(cells)
   def broken(self):
+    bitset = self.bitset
+    if bitset is not None:
+      return not all(bitset.masks)
     return not all(self._cell_options.values())
   def constraints_satisfied(self):
     return all(c(self) for c in self._constraints.values())
   def free_cells(self):
+    bitset = self.bitset
+    if bitset is not None:
+      return sum(1 for m in bitset.masks if m & (m-1))
     return sum(1 for opts in self._cell_options.values() if len(opts) > 1)
   def save(self):
-    return pickle.dumps((self._cell_options, self._constraints, self._deductions))
+    """
+    Returns the puzzle pickled, for 'load'. With a topology, only what differs
+    from it is kept: the constraints added, replaced or removed, and in
+    compact mode, the masks.
+    """
+    topology = self._topology
+    if topology is None:
+      return pickle.dumps((None, self._cell_options, self._constraints, self._deductions, self._derived))
+    cell_options = self._cell_options
+    if self.bitset is not None and topology.shares_layout(cell_options):
+      cell_options = cell_options.masks
+    shared = topology.constraints
+    added = {name: c for name, c in self._constraints.items() if shared.get(name) is not c}
+    removed = [name for name in shared if name not in self._constraints]
+    # the order is only kept if it isn't the one 'load' would give
+    order = [name for name in shared if name in self._constraints] + [name for name in added if name not in shared]
+    order = None if order == list(self._constraints) else list(self._constraints)
+    return pickle.dumps((topology, cell_options, (added, removed, order), self._deductions, self._derived))
   def load(self, data):
-    self._cell_options, self._constraints, self._deductions = pickle.loads(data)
+    topology, cell_options, constraints, self._deductions, self._derived = pickle.loads(data)
+    self._topology = topology
+    self._cell_constraints = None
+    if topology is not None:
+      if isinstance(cell_options, list):
+        cell_options = topology.bitset(cell_options)
+      added, removed, order = constraints
+      constraints = dict(topology.constraints)
+      for name in removed:
+        del constraints[name]
+      constraints.update(added)
+      if order is not None:
+        constraints = {name: constraints[name] for name in order}
+      if not added and not removed:
+        self._cell_constraints = topology.cell_constraints
+        self._peers = topology.peers
+    self._cell_options = cell_options
+    self._constraints = constraints
+    self._checkpoints = []
+    self._stamp = next(_clock)
+  def checkpoint(self):
+    """
+    Marks a point that 'rollback' can return to. Unlike 'save', only the cell
+    option changes made after the checkpoint are recorded, and constraints and
+    deductions are copied shallowly. Checkpoints nest.
+    """
+    cell_options = self._cell_options
+    if cell_options._trail is None:
+      cell_options._trail = []
+    deductions = {k: copy.copy(v) for k, v in self._deductions.items()}
+    self._checkpoints.append((len(cell_options._trail), dict(self._constraints), dict(self._derived), deductions,
+      self._stamp))
+  def rollback(self):
+    # Undoes every change made since the last checkpoint and drops it.
+    pos, constraints, derived, deductions, stamp = self._checkpoints.pop()
+    cell_options = self._cell_options
+    trail = cell_options._trail
+    while len(trail) > pos:
+      cell_options._restore(*trail.pop())
+    if not self._checkpoints:
+      cell_options._trail = None
+    self._stamp = stamp
+    if self._constraints != constraints:
+      if self._cell_constraints is not None:
+        for name, constraint in self._constraints.items():
+          if constraints.get(name) is not constraint:
+            self._unindex(name, constraint)
+        for name, constraint in constraints.items():
+          if self._constraints.get(name) is not constraint:
+            self._index(name, constraint)
+      self._constraints.clear()
+      self._constraints.update(constraints)
+    self._derived = derived
+    self._deductions.clear()
+    self._deductions.update(deductions)
+  def commit(self):
+    # Keeps the changes made since the last checkpoint and drops it.
+    self._checkpoints.pop()
+    if not self._checkpoints:
+      self._cell_options._trail = None
 
 class Constraint:
+  # cached dense cell ids, valid for the BitsetCellOptions index they came from
+  _cell_ids = None
+  _cell_ids_index = None
   def __init__(self, cells, options):
     self._cells = list(cells)
   @ property
   def cells(self):
     return self._cells
+  def cell_ids(self, bitset):
+    if self._cell_ids_index is not bitset.index:
+      self._cell_ids = bitset.ids(self._cells)
+      self._cell_ids_index = bitset.index
+    return self._cell_ids
   def __call__(self, puzzle):
     raise NotImplementedError('__call__ not implemented for {}'.format(type(self)))
   def implies_uniqueness(self):
     return False
+  def rules_out(self, puzzle, cid, opt):
+    # Returns true if locking cell 'cid' to 'opt' would violate the constraint
+    # or make it impossible to satisfy.
+    old = puzzle.cell_options._swap(cid, [opt])
+    try:
+      return not self(puzzle) or self.broken(puzzle)
+    finally:
+      puzzle.cell_options._swap(cid, old)
+  def options_ruled_out(self, puzzle, cid, opts):
+    # The set of 'opts' that 'rules_out' rules out for cell 'cid'.
+    return set(opt for opt in opts if self.rules_out(puzzle, cid, opt))
+  def propagate(self, puzzle):
+    # The options each of the constraint's cells can keep, {cid: [options]},
+    # found by the constraint's own reasoning rather than by trying each
+    # option with 'rules_out', or None if it has no propagator.
+    return None
   def broken(self, puzzle):
     # Returns true if the constraint is impossible to satisfy with the
     # current cell options, even if it's not currently violated.
     if self.implies_uniqueness():
+      bitset = puzzle.bitset
+      if bitset is not None:
+        masks = bitset.masks
+        union = 0
+        for i in self.cell_ids(bitset):
+          union |= masks[i]
+        return popcount(union) != len(self.cells)
       opt_set = set()
       for cid in self.cells:
         opt_set.update(puzzle.cell_options[cid])
@@ -48,72 +569,379 @@ class Constraint:
 
 class OneEachConstraint(Constraint):
   def __init__(self, cells, options):
-    self._cells = list(cells)
+    super().__init__(cells, options)
     self._options = list(options)
+    self._cell_set = frozenset(self._cells)
   def __call__(self, puzzle):
+    bitset = puzzle.bitset
+    if bitset is not None:
+      masks = bitset.masks
+      locked = 0
+      for i in self.cell_ids(bitset):
+        m = masks[i]
+        if m and not m & (m-1):
+          if locked & m:
+            return False
+          locked |= m
+      return True
     options = (puzzle._cell_options[cid] for cid in self.cells)
     locked_cells = [opts[0] for opts in options if len(opts) == 1]
     return len(locked_cells) == len(set(locked_cells))
+  def rules_out(self, puzzle, cid, opt):
+    if cid not in self._cell_set:
+      return super().rules_out(puzzle, cid, opt)
+    return bool(self.options_ruled_out(puzzle, cid, [opt]))
+  def options_ruled_out(self, puzzle, cid, opts):
+    if cid not in self._cell_set:
+      return super().options_ruled_out(puzzle, cid, opts)
+    # same as the generic check, but in one pass and without writing to the
+    # puzzle: an option is ruled out if another cell is locked to it, or if
+    # it would leave the wrong number of options across the cells
+    n = len(self._cells)
+    bitset = puzzle.bitset
+    if bitset is not None:
+      masks = bitset.masks
+      own = bitset.index[cid]
+      locked = union = 0
+      for i in self.cell_ids(bitset):
+        if i == own:
+          continue
+        m = masks[i]
+        union |= m
+        if m and not m & (m-1):
+          if locked & m:
+            return set(opts)
+          locked |= m
+      ruled_out = set()
+      for opt in opts:
+        bit = bitset.bit(opt)
+        if locked & bit or popcount(union | bit) != n:
+          ruled_out.add(opt)
+      return ruled_out
+    locked, union = set(), set()
+    for other in self._cells:
+      if other == cid:
+        continue
+      other_opts = puzzle.cell_options[other]
+      union.update(other_opts)
+      if len(other_opts) == 1:
+        if other_opts[0] in locked:
+          return set(opts)
+        locked.add(other_opts[0])
+    return set(opt for opt in opts if opt in locked or len(union | {opt}) != n)
   @ property
   def options(self):
     return self._options
   def implies_uniqueness(self):
     return True
 
+class PropagatedConstraint(Constraint):
+  """
+  A constraint with a propagator: 'propagate' prunes the options of all its
+  cells at once, and 'rules_out' and 'broken' are answered from it, so the
+  solver never has to try options one at a time against the constraint.
+  """
+  def __init__(self, cells, options):
+    super().__init__(cells, options)
+    self._options = sorted(options)
+    self._cell_set = frozenset(self._cells)
+  @ property
+  def options(self):
+    return self._options
+  def propagate(self, puzzle):
+    raise NotImplementedError('propagate not implemented for {}'.format(type(self)))
+  def rules_out(self, puzzle, cid, opt):
+    if cid not in self._cell_set:
+      return super().rules_out(puzzle, cid, opt)
+    return bool(self.options_ruled_out(puzzle, cid, [opt]))
+  def options_ruled_out(self, puzzle, cid, opts):
+    if cid not in self._cell_set:
+      return super().options_ruled_out(puzzle, cid, opts)
+    return set(opts).difference(self.propagate(puzzle)[cid])
+  def broken(self, puzzle):
+    return not all(self.propagate(puzzle).values())
+  def _solved(self, puzzle):
+    # The options of the solved cells, in cell order.
+    options = (puzzle.cell_options[cid] for cid in self._cells)
+    return [opts[0] for opts in options if len(opts) == 1]
+
+class SumConstraint(PropagatedConstraint):
+  """
+  The cells' options add up to 'total', as in a killer sudoku cage, and with
+  'distinct' no option repeats. Distinct sums are pruned with a table of the
+  sets of options that make the total (see 'combinations'): a cell keeps the
+  options of the sets its cells can still fill. Otherwise each cell keeps the
+  options the other cells' smallest and largest options leave room for.
+  """
+  # (options, cells, total) -> masks of options making the total
+  _tables = {}
+  def __init__(self, cells, options, total, distinct=True):
+    super().__init__(cells, options)
+    self.total = total
+    self.distinct = distinct
+    self._bits = {opt: 1 << i for i, opt in enumerate(self._options)}
+  @ classmethod
+  def combinations(cls, options, count, total):
+    # The sets of 'count' of the sorted 'options' adding up to 'total', as
+    # masks with bit i for options[i]. Tables are kept for the process.
+    key = (tuple(options), count, total)
+    table = cls._tables.get(key)
+    if table is None:
+      table = cls._tables[key] = [sum(1 << i for i in combo) for combo in itertools.combinations(range(len(options)), count)
+        if sum(options[i] for i in combo) == total]
+    return table
+  def __call__(self, puzzle):
+    solved = self._solved(puzzle)
+    if self.distinct and len(solved) != len(set(solved)):
+      return False
+    unsolved = len(self._cells)-len(solved)
+    low = sum(solved) + unsolved*self._options[0]
+    high = sum(solved) + unsolved*self._options[-1]
+    return low <= self.total <= high
+  def propagate(self, puzzle):
+    bits = self._bits
+    masks = []
+    for cid in self._cells:
+      m = 0
+      for opt in puzzle.cell_options[cid]:
+        m |= bits.get(opt, 0)
+      masks.append(m)
+    allowed = self._combination_support(masks) if self.distinct else self._bounds(masks)
+    return {cid: [opt for opt in puzzle.cell_options[cid] if bits.get(opt, 0) & a] for cid, a in zip(self._cells, allowed)}
+  def _combination_support(self, masks):
+    n = len(masks)
+    fixed = 0
+    for m in masks:
+      if m and not m & (m-1):
+        if fixed & m:
+          return [0]*n
+        fixed |= m
+    # solved cells' options are taken from the others
+    masks = [m if not m & (m-1) else m & ~fixed for m in masks]
+    union = 0
+    for m in masks:
+      union |= m
+    allowed = [0]*n
+    for combo in self.combinations(self._options, n, self.total):
+      # every option of the set has to go in some cell, and every cell needs
+      # one of them
+      if fixed & ~combo or combo & ~union:
+        continue
+      cells = [m & combo for m in masks]
+      if all(cells):
+        for i, m in enumerate(cells):
+          allowed[i] |= m
+    return allowed
+  def _bounds(self, masks):
+    options = self._options
+    low = lambda m: options[(m & -m).bit_length()-1]
+    high = lambda m: options[m.bit_length()-1]
+    masks = list(masks)
+    changed = True
+    while changed and all(masks):
+      changed = False
+      lows = sum(map(low, masks))
+      highs = sum(map(high, masks))
+      for i, m in enumerate(masks):
+        # what the other cells can add up to
+        least = lows-low(m)
+        most = highs-high(m)
+        kept = 0
+        for j, opt in enumerate(options):
+          if m >> j & 1 and least <= self.total-opt <= most:
+            kept |= 1 << j
+        if kept != m:
+          masks[i] = kept
+          changed = True
+          break
+    return masks if all(masks) else [0]*len(masks)
+
+class OrderedConstraint(PropagatedConstraint):
+  """
+  The cells' options increase along the cells, as on a thermometer from its
+  bulb, or for two cells, a greater-than sign pointing at the first. With
+  'strict' false, neighbours may be equal. Each cell only keeps the options
+  above the least of the cell before and below the greatest of the cell
+  after, found in one pass each way.
+  """
+  def __init__(self, cells, options, strict=True):
+    super().__init__(cells, options)
+    self.strict = strict
+  def __call__(self, puzzle):
+    solved = self._solved(puzzle)
+    if self.strict:
+      return all(a < b for a, b in zip(solved, solved[1:]))
+    return all(a <= b for a, b in zip(solved, solved[1:]))
+  def propagate(self, puzzle):
+    cells = self._cells
+    allowed = [puzzle.cell_options[cid] for cid in cells]
+    if self.strict:
+      above, below = (lambda opt, bound: opt > bound), (lambda opt, bound: opt < bound)
+    else:
+      above, below = (lambda opt, bound: opt >= bound), (lambda opt, bound: opt <= bound)
+    for i in range(1, len(cells)):
+      if allowed[i-1]:
+        bound = min(allowed[i-1])
+        allowed[i] = [opt for opt in allowed[i] if above(opt, bound)]
+      else:
+        allowed[i] = []
+    for i in range(len(cells)-2, -1, -1):
+      if allowed[i+1]:
+        bound = max(allowed[i+1])
+        allowed[i] = [opt for opt in allowed[i] if below(opt, bound)]
+      else:
+        allowed[i] = []
+    return dict(zip(cells, allowed))
+
 class Sudoku(PuzzleState):
-  def __init__(self):
-    super().__init__()
+  """
+  A sudoku of 'box_rows' x 'box_cols' boxes, so with rows, columns and boxes
+  of size = box_rows*box_cols cells and options 1 to size. The default is
+  the usual 9x9 board; Sudoku(box_rows=4) is a 16x16 hexadoku and
+  Sudoku(box_rows=2, box_cols=3) a 6x6 board of 2 row by 3 column boxes.
+  """
+  # the characters for options 1, 2, ... in strings
+  SYMBOLS = '123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+  # (class, box_rows, box_cols) -> Topology
+  _topologies = {}
+  def __init__(self, compact=False, box_rows=3, box_cols=None):
+    if box_cols is None:
+      box_cols = box_rows
+    super().__init__(self.shared_topology(box_rows, box_cols))
+    self.box_rows = box_rows
+    self.box_cols = box_cols
+    self.size = box_rows*box_cols
+    if compact:
+      self.compact()
+  @classmethod
+  def shared_topology(cls, box_rows=3, box_cols=None, cache_dir=None):
+    """
+    The Topology shared by every board of 'box_rows' x 'box_cols' boxes, built
+    on first use. With a 'cache_dir', it is loaded from a file there if one
+    was saved before, and saved there otherwise.
+    """
+    if box_cols is None:
+      box_cols = box_rows
+    key = (cls, box_rows, box_cols)
+    topology = Sudoku._topologies.get(key)
+    if topology is None:
+      source = (cls.shared_topology, (box_rows, box_cols))
+      path = None
+      if cache_dir is not None:
+        path = os.path.join(cache_dir, '{}-{}x{}.topology'.format(cls.__name__.lower(), box_rows, box_cols))
+      if path is not None and os.path.exists(path):
+        topology = Topology.load(path, source=source)
+      else:
+        topology = Topology(*cls._layout(box_rows, box_cols), source=source)
+        if path is not None:
+          topology.save(path)
+      Sudoku._topologies[key] = topology
+    return topology
+  @classmethod
+  def _layout(cls, box_rows, box_cols):
+    # The (cell options, constraints) of an empty board.
+    size = box_rows*box_cols
+    cell_options = {}
+    constraints = {}
     # Set up the cell states
-    for r in range(1,10):
-      for c in range(1,10):
-        self._cell_options[(r,c)] = list(range(1,10))
-    opt_it = partial(range, 1, 10)
+    for r in range(1,size+1):
+      for c in range(1,size+1):
+        cell_options[(r,c)] = list(range(1,size+1))
+    opt_it = partial(range, 1, size+1)
     # Set up the row constraints
     def row_it(r):
-      for c in range(1,10):
+      for c in range(1,size+1):
         yield (r,c)
-    for r in range(1,10):
-      self._constraints['Row {}'.format(r)] = OneEachConstraint(row_it(r), opt_it())
+    for r in range(1,size+1):
+      constraints['Row {}'.format(r)] = OneEachConstraint(row_it(r), opt_it())
     # Set up column constraints
     def col_it(c):
-      for r in range(1,10):
+      for r in range(1,size+1):
         yield (r,c)
-    for c in range(1,10):
-      self._constraints['Col {}'.format(c)] = OneEachConstraint(col_it(c), opt_it())
-    # Set up box constraints
+    for c in range(1,size+1):
+      constraints['Col {}'.format(c)] = OneEachConstraint(col_it(c), opt_it())
+    # Set up box constraints, numbered across then down
     def box_it(r_off, c_off):
-      for i in range(9):
-        r = r_off+int(i/3)+1
-        c = c_off+i%3+1
+      for i in range(size):
+        r = r_off+i//box_cols+1
+        c = c_off+i%box_cols+1
         yield (r, c)
-    for box_num in range(1,10):
-      r_off = 3*int((box_num-1)/3)
-      c_off = 3*((box_num-1)%3)
-      self._constraints['Box {}'.format(box_num)] = OneEachConstraint(box_it(r_off, c_off), opt_it())
+    boxes_across = size//box_cols
+    for box_num in range(1,size+1):
+      r_off = box_rows*((box_num-1)//boxes_across)
+      c_off = box_cols*((box_num-1)%boxes_across)
+      constraints['Box {}'.format(box_num)] = OneEachConstraint(box_it(r_off, c_off), opt_it())
+    return cell_options, constraints
+  @classmethod
+  def box_shape(cls, size):
+    # The (box_rows, box_cols) of a board of the given size, with boxes as
+    # close to square as possible and no taller than they are wide.
+    box_rows = max(d for d in range(1, int(size**0.5)+1) if size % d == 0)
+    return box_rows, size//box_rows
+  @classmethod
+  def from_string(cls, data, compact=False):
+    # A board sized for a string 'load_from_string' can load, loaded with it.
+    data = data.strip()
+    size = int(round(len(data)**0.5))
+    if size*size != len(data) or size > len(cls.SYMBOLS):
+      raise ValueError('{} cells is not a square board'.format(len(data)))
+    box_rows, box_cols = cls.box_shape(size)
+    puzzle = cls(compact=compact, box_rows=box_rows, box_cols=box_cols)
+    puzzle.load_from_string(data)
+    return puzzle
+  def _symbol(self, cid):
+    opts = self._cell_options[cid]
+    return self.SYMBOLS[opts[0]-1] if len(opts) == 1 else None
   def __str__(self):
+    size, box_rows, box_cols = self.size, self.box_rows, self.box_cols
+    rule = '+'.join(['-'*(2*box_cols)]*(size//box_cols))
     def char_iter():
-      for r in range(1,10):
+      for r in range(1,size+1):
         if r != 1:
           yield '\n'
-        if r == 4 or r == 7:
-          yield '------+------+------\n'
-        for c in range(1,10):
+        if r != 1 and (r-1) % box_rows == 0:
+          yield rule+'\n'
+        for c in range(1,size+1):
           if c != 1:
             yield ' '
-          if c == 4 or c == 7:
+          if c != 1 and (c-1) % box_cols == 0:
             yield '|'
-          opts = self._cell_options[(r,c)]
-          if len(opts) == 1:
-            yield str(opts[0])
-          else:
-            yield '.'
+          yield self._symbol((r,c)) or '.'
     return ''.join(char_iter())
   def load_from_list(self, data):
-    for r in range(1,10):
-      for c in range(1,10):
+    for r in range(1,self.size+1):
+      for c in range(1,self.size+1):
         v = data[r-1][c-1]
         if v != 0:
           self._cell_options[(r,c)] = [v]
+  def load_from_string(self, data):
+    # Loads givens from a row-major string of size*size characters, with
+    # options written as SYMBOLS ('1'-'9', then 'A' for 10 and so on) and '0'
+    # or '.' for blank cells.
+    size = self.size
+    data = data.strip()
+    if len(data) != size*size:
+      raise ValueError('expected {} cells, got {}'.format(size*size, len(data)))
+    values = {ch: i+1 for i, ch in enumerate(self.SYMBOLS[:size])}
+    rows = []
+    for r in range(size):
+      row = []
+      for ch in data[size*r:size*r+size]:
+        if ch in '0.':
+          row.append(0)
+        elif ch.upper() in values:
+          row.append(values[ch.upper()])
+        else:
+          raise ValueError('invalid cell {!r}'.format(ch))
+      rows.append(row)
+    self.load_from_list(rows)
+  def to_string(self, blank='.'):
+    # The inverse of 'load_from_string', with 'blank' for unsolved cells.
+    def char_iter():
+      for r in range(1,self.size+1):
+        for c in range(1,self.size+1):
+          yield self._symbol((r,c)) or blank
+    return ''.join(char_iter())
 
 if __name__=='__main__':
   puzzle = Sudoku()
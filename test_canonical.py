@@ -0,0 +1,57 @@
+import state
+import solver
+import canonical
+import random
+
+# unique, from corpus/singles.txt
+GRID = '.8.4.3.2....87....1.9.....3.....8....2561.......5...31..23..9..8.....34..1..85...'
+
+def shuffled_lines(rng, groups, size):
+  # A random order of 'size' lines in 'groups' blocks, keeping blocks together.
+  block = size//groups
+  order = []
+  for g in rng.sample(range(groups), groups):
+    order.extend(rng.sample(range(g*block, (g+1)*block), block))
+  return order
+
+def transform(grid, rng):
+  # 'grid' with its bands, rows within bands, stacks, columns within stacks
+  # and options shuffled, and maybe transposed, with the function doing it.
+  rows = shuffled_lines(rng, 3, 9)
+  cols = shuffled_lines(rng, 3, 9)
+  labels = dict(zip('123456789', rng.sample('123456789', 9)))
+  transpose = rng.random() < 0.5
+  def apply(grid):
+    cells = [labels.get(grid[r*9+c], '.') for r in rows for c in cols]
+    if transpose:
+      cells = [cells[c*9+r] for r in range(9) for c in range(9)]
+    return ''.join(cells)
+  return apply(grid), apply
+
+def test_key_is_the_same_under_symmetries():
+  rng = random.Random(1)
+  key, _ = canonical.canonical_form(state.Sudoku.from_string(GRID))
+  for _ in range(20):
+    grid, _ = transform(GRID, rng)
+    assert canonical.canonical_form(state.Sudoku.from_string(grid))[0] == key
+
+def test_cache_maps_solution_back():
+  rng = random.Random(2)
+  puzzle = state.Sudoku.from_string(GRID)
+  form = canonical.canonical_form(puzzle)
+  trace = []
+  step = lambda name, found: trace.append((name, found.kind, [(cid, puzzle.cell_options[cid]) for cid in found.cells_affected]))
+  assert solver.SudokuSolver().solve(puzzle, step=step).reason == 'solved'
+  solution = puzzle.to_string()
+  cache = canonical.SolutionCache()
+  cache.put(form, puzzle.cell_options, trace)
+  for _ in range(5):
+    grid, apply = transform(GRID, rng)
+    expected = state.Sudoku.from_string(apply(solution))
+    cell_options, cached_trace = cache.get(canonical.canonical_form(state.Sudoku.from_string(grid)))
+    assert cell_options == dict(expected.cell_options)
+    assert len(cached_trace) == len(trace)
+    for name, kind, cells in cached_trace:
+      for cid, opts in cells:
+        assert expected.cell_options[cid][0] in opts
+  assert cache.hits == 5
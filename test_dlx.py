@@ -0,0 +1,24 @@
+import state
+import dlx
+import search
+
+# unique, from corpus/singles.txt
+UNIQUE = '.8.4.3.2....87....1.9.....3.....8....2561.......5...31..23..9..8.....34..1..85...'
+# the same with its first three rows blanked, which has several solutions
+MULTIPLE = '.'*27 + UNIQUE[27:]
+
+def test_count_solutions_matches_search():
+  for grid, limit in ((UNIQUE, 2), (MULTIPLE, 2), (MULTIPLE, 5)):
+    puzzle = state.Sudoku.from_string(grid)
+    expected = search.count_solutions(puzzle, limit=limit)
+    assert dlx.count_solutions(puzzle, limit=limit) == expected
+  assert search.count_solutions(state.Sudoku.from_string(UNIQUE), limit=2) == 1
+  assert search.count_solutions(state.Sudoku.from_string(MULTIPLE), limit=5) == 5
+
+def test_solution_is_consistent():
+  puzzle = state.Sudoku.from_string(UNIQUE)
+  solution = dlx.solve(puzzle)
+  for cid, opts in solution.items():
+    puzzle.cell_options[cid] = opts
+  assert puzzle.free_cells() == 0 and puzzle.constraints_satisfied()
+  assert solution == search.solve(state.Sudoku.from_string(UNIQUE))
@@ -0,0 +1,26 @@
+import state
+import dense
+import generate
+import search
+
+# unique, from corpus/singles.txt
+UNIQUE = '.8.4.3.2....87....1.9.....3.....8....2561.......5...31..23..9..8.....34..1..85...'
+# the same with its first three rows blanked, which has several solutions
+MULTIPLE = '.'*27 + UNIQUE[27:]
+
+def test_count_solutions_matches_search():
+  for grid, limit in ((UNIQUE, 2), (MULTIPLE, 2), (MULTIPLE, 5)):
+    expected = search.count_solutions(state.Sudoku.from_string(grid), limit=limit)
+    assert generate.count_solutions(dense.parse(grid)[1], limit=limit) == expected
+
+def test_generated_puzzles_are_unique():
+  for box_rows, box_cols, tier in ((3, 3, None), (2, 3, None), (3, 3, 'singles')):
+    generator = generate.Generator(box_rows, box_cols, seed=1)
+    grid = generator.generate(tier)
+    size, cells = dense.parse(grid)
+    assert size == box_rows*box_cols
+    puzzle = state.Sudoku(box_rows=box_rows, box_cols=box_cols)
+    puzzle.load_from_string(grid)
+    assert search.count_solutions(puzzle, limit=2) == 1
+    if tier is not None:
+      assert generator.grade(cells) == tier
@@ -0,0 +1,59 @@
+import state
+import solver
+
+def row_puzzle(options):
+  # A Sudoku with the options of row 1's cells set, in order.
+  puzzle = state.Sudoku()
+  for c, opts in enumerate(options, 1):
+    puzzle.cell_options[(1,c)] = opts
+  return puzzle
+
+def deduce_row(puzzle):
+  _, deducer = solver.get_tuple_deducer()
+  return deducer(puzzle, [('Row 1', puzzle.constraints['Row 1'])])
+
+def row(puzzle):
+  return [puzzle.cell_options[(1,c)] for c in range(1, 10)]
+
+def test_naked_tuple():
+  rest = [3,4,5,6,7,8,9]
+  puzzle = row_puzzle([[1,2], [1,2]] + [[1,2]+rest]*7)
+  deduction = deduce_row(puzzle)
+  assert deduction.kind == 'tuple'
+  assert row(puzzle) == [[1,2], [1,2]] + [rest]*7
+
+def test_hidden_tuple_without_naked_complement():
+  # the complement of the hidden pair is a naked 7-tuple, bigger than the
+  # search goes
+  rest = [3,4,5,6,7,8,9]
+  puzzle = row_puzzle([[1,2,3,4], [1,2,5,6]] + [rest]*7)
+  deduction = deduce_row(puzzle)
+  assert deduction.kind == 'hidden tuple'
+  assert sorted(deduction.cells_affected) == [(1,1), (1,2)]
+  assert row(puzzle) == [[1,2], [1,2]] + [rest]*7
+
+def test_tuples_at_most_half_the_unlocked_cells():
+  # with 3 unlocked cells only tuples of 1 could split them, which are singles
+  puzzle = row_puzzle([[1,2], [1,2], [1,2,3], [4], [5], [6], [7], [8], [9]])
+  assert deduce_row(puzzle) is None
+
+def test_no_hidden_tuple_of_placed_option():
+  # 5 is placed, so (1,2) = 1 and (1,3) = 7 can still hold although only they
+  # have 5 and 7 among the unlocked cells
+  puzzle = row_puzzle([[5], [1,5,7], [2,5,7]] + [[1,2,3,4,6,8,9]]*6)
+  while deduce_row(puzzle):
+    pass
+  assert 1 in puzzle.cell_options[(1,2)] and 7 in puzzle.cell_options[(1,3)]
+
+def test_no_hidden_tuple_with_more_options_than_cells():
+  # not every option of the constraint has to be used, so options only in
+  # two cells needn't go in them: every option here is in some solution
+  _, deducer = solver.get_tuple_deducer()
+  puzzle = state.PuzzleState()
+  cells = [(1,1), (1,2), (1,3), (1,4)]
+  options = [[1,2,3], [1,2,4], [5,6], [5,6,7]]
+  for cid, opts in zip(cells, options):
+    puzzle.cell_options[cid] = opts
+  puzzle.add_constraint('Cage', state.OneEachConstraint(cells, range(1,10)))
+  assert deducer(puzzle) is None
+  assert [puzzle.cell_options[cid] for cid in cells] == options